@@ -0,0 +1,136 @@
+"""
+Benchmarks for the entry points which are typically called from cron jobs
+
+``run(scale)`` seeds ``scale`` users with a Stripe customer, a monthly
+subscription and a few line items each and then measures the wall time,
+the number of queries and the peak memory usage of each entry point.
+Charges are handled by a local stand-in for ``stripe.Charge.create``
+which declines the cards of every other customer.
+"""
+
+import logging
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import date, timedelta
+from decimal import Decimal
+from unittest import mock
+
+import stripe
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from testapp.processing import processors
+
+from user_payments.models import LineItem, Payment
+from user_payments.processing import process_pending_payments, process_unbound_items
+from user_payments.stripe_customers.models import Customer
+from user_payments.user_subscriptions.models import Subscription, SubscriptionPeriod
+
+
+def fake_charge(*, customer, amount, **kwargs):
+    if int(customer.rsplit("_", 1)[-1]) % 2:
+        raise stripe.error.CardError("Your card was declined.", None, "card_declined")
+    return {"id": f"ch_{customer}", "amount": amount, "paid": True}
+
+
+def seed(scale):
+    users = User.objects.bulk_create(
+        [
+            User(username=f"bench{i}", email=f"bench{i}@example.com")
+            for i in range(scale)
+        ]
+    )
+    users = list(User.objects.filter(username__startswith="bench").order_by("pk"))
+    Customer.objects.bulk_create(
+        [
+            Customer(
+                user=user,
+                customer_id=f"cus_bench_{i}",
+                customer_data={
+                    "default_source": {
+                        "brand": "Visa",
+                        "last4": "4242",
+                        "exp_month": 12,
+                        "exp_year": 2040,
+                    }
+                },
+            )
+            for i, user in enumerate(users)
+        ]
+    )
+    starts_on = date.today() - timedelta(days=90)
+    Subscription.objects.bulk_create(
+        [
+            Subscription(
+                user=user,
+                code="bench",
+                title="Benchmark",
+                periodicity="monthly",
+                amount=Decimal("10"),
+                starts_on=starts_on,
+                paid_until=starts_on - timedelta(days=1),
+            )
+            for user in users
+        ]
+    )
+    LineItem.objects.bulk_create(
+        [
+            LineItem(user=user, title=f"Item {j}", amount=Decimal("1.50"))
+            for user in users
+            for j in range(3)
+        ]
+    )
+
+
+@contextmanager
+def measure(results, name):
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        with CaptureQueriesContext(connection) as queries:
+            yield
+    finally:
+        seconds = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    results[name] = {
+        "seconds": round(seconds, 4),
+        "queries": len(queries),
+        "peak_kib": peak // 1024,
+    }
+
+
+def run(scale):
+    """
+    Seed ``scale`` users and run the entry points in the order recommended
+    in the processing documentation. Returns a dictionary mapping entry
+    point names to their measurements.
+    """
+    seed(scale)
+    results = {}
+    logging.disable(logging.CRITICAL)
+    try:
+        with mock.patch.object(stripe.Charge, "create", side_effect=fake_charge):
+            with measure(results, "create_periods"):
+                Subscription.objects.create_periods()
+            with measure(results, "create_line_items"):
+                SubscriptionPeriod.objects.create_line_items()
+            with measure(results, "process_unbound_items"):
+                process_unbound_items(processors=processors, bulk=True)
+
+            # Declined payments have been canceled, try again.
+            list(Payment.objects.create_pending_bulk())
+            with measure(results, "process_pending_payments"):
+                process_pending_payments(processors=processors)
+            # Declined payments are still pending.
+            with measure(results, "process_pending_payments_workers"):
+                process_pending_payments(processors=processors, workers=1)
+
+            with measure(results, "zeroize_pending_periods"):
+                SubscriptionPeriod.objects.zeroize_pending_periods()
+            with measure(results, "disable_autorenewal"):
+                Subscription.objects.disable_autorenewal(bulk=True)
+    finally:
+        logging.disable(logging.NOTSET)
+    return results
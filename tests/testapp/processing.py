@@ -20,7 +20,10 @@ def with_stripe_customer(payment):
     except ObjectDoesNotExist:
         return Result.FAILURE
 
-    if (timezone.now() - customer.updated_at).total_seconds() > 30 * 86400:
+    if (
+        apps.get_app_config("stripe_customers").settings.refresh_on_charge
+        and customer.needs_refresh
+    ):
         customer.refresh()
 
     s = apps.get_app_config("user_payments").settings
@@ -0,0 +1,58 @@
+import json
+import os
+
+from django.db import transaction
+from django.test import TestCase
+from django.utils.translation import deactivate_all
+from testapp.benchmarks import run
+
+
+BASELINE = os.path.join(os.path.dirname(__file__), "benchmarks.json")
+
+
+def scales():
+    """
+    ``USER_PAYMENTS_BENCHMARK_SCALES="10,100,1000"`` runs the benchmarks at
+    additional scales. Scales without a baseline are only reported.
+    """
+    value = os.environ.get("USER_PAYMENTS_BENCHMARK_SCALES", "10,20")
+    return [int(scale) for scale in value.split(",")]
+
+
+class Test(TestCase):
+    def setUp(self):
+        deactivate_all()
+
+    def test_benchmarks(self):
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+
+        report = {}
+        for scale in scales():
+            with transaction.atomic():
+                report[str(scale)] = run(scale)
+                transaction.set_rollback(True)
+
+        if os.environ.get("USER_PAYMENTS_BENCHMARK_UPDATE"):
+            # Only query counts are stable enough to be compared.
+            baseline.update(
+                {
+                    scale: {name: m["queries"] for name, m in results.items()}
+                    for scale, results in report.items()
+                }
+            )
+            with open(BASELINE, "w") as f:
+                json.dump(baseline, f, indent=2, sort_keys=True)
+                f.write("\n")
+
+        if os.environ.get("USER_PAYMENTS_BENCHMARK_VERBOSE"):
+            print(json.dumps(report, indent=2))
+
+        for scale, results in report.items():
+            for name, measurement in results.items():
+                if name not in baseline.get(scale, {}):
+                    continue
+                with self.subTest(scale=scale, entry_point=name):
+                    self.assertLessEqual(
+                        measurement["queries"], baseline[scale][name], measurement
+                    )
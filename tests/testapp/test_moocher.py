@@ -14,7 +14,10 @@ class AttrDict(dict):
     """Dictionary which also allows attribute access to its items"""
 
     def __getattr__(self, key):
-        return self[key]
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
 
 
 class Test(TestCase):
@@ -1,9 +1,20 @@
+import atexit
+import io
+from decimal import Decimal
+from unittest import mock
+
+from django.apps import apps
 from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.signals import request_finished
+from django.db import DatabaseError, IntegrityError, transaction
 from django.test import Client, TestCase
 from django.utils import timezone
 from django.utils.translation import deactivate_all
 
-from user_payments.models import LineItem, Payment
+from user_payments import metering
+from user_payments.metering import LineItemBuffer
+from user_payments.models import Balance, LineItem, Payment
 
 
 class Test(TestCase):
@@ -53,6 +64,30 @@ class Test(TestCase):
         self.assertEqual(LineItem.objects.unpaid().count(), 0)
         self.assertEqual(str(payment), "Payment of 5.00")
 
+    def test_with_description(self):
+        for i in range(3):
+            user = User.objects.create(username=f"test{i}", email=f"test{i}@a.com")
+            LineItem.objects.create(user=user, amount=5, title="Something")
+            LineItem.objects.create(user=user, amount=5, title="Else")
+            Payment.objects.create_pending(user=user)
+
+        with self.assertNumQueries(2):
+            descriptions = [
+                payment.description
+                for payment in Payment.objects.with_description().order_by("email")
+            ]
+        self.assertEqual(
+            descriptions[0], "Payment of 10.00 by test0@a.com: Else, Something"
+        )
+
+        payment = Payment.objects.order_by("email").first()
+        with self.assertNumQueries(1):
+            self.assertEqual(payment.description, descriptions[0])
+
+        s = apps.get_app_config("user_payments").settings
+        with mock.patch.object(s, "description_max_length", 20):
+            self.assertEqual(payment.description, "Payment of 10.00 by…")
+
     def test_explicit_lineitems(self):
         LineItem.objects.create(user=self.user, amount=5, title="Something")
         item = LineItem.objects.create(user=self.user, amount=5, title="Something")
@@ -60,3 +95,229 @@ class Test(TestCase):
         payment = Payment.objects.create_pending(user=self.user, lineitems=[item])
         self.assertEqual(payment.amount, 5)
         self.assertEqual(LineItem.objects.unbound().count(), 1)
+
+    def test_create_pending_bulk(self):
+        self.assertEqual(list(Payment.objects.create_pending_bulk()), [])
+
+        other = User.objects.create(username="other", email="other@example.com")
+        third = User.objects.create(username="third", email="third@example.com")
+        LineItem.objects.create(user=self.user, amount=5, title="Something")
+        LineItem.objects.create(user=self.user, amount=10, title="Else")
+        LineItem.objects.create(user=other, amount=7, title="Something")
+        LineItem.objects.create(user=third, amount=3, title="Something")
+
+        with self.assertNumQueries(1 + 2 * 6 + 3):
+            chunks = list(Payment.objects.create_pending_bulk(chunk_size=2))
+
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 1])
+        payments = {payment.user: payment for chunk in chunks for payment in chunk}
+        self.assertEqual(payments[self.user].amount, 15)
+        self.assertEqual(payments[self.user].email, "admin@test.ch")
+        self.assertEqual(payments[other].amount, 7)
+        self.assertEqual(payments[third].amount, 3)
+
+        self.assertEqual(LineItem.objects.unbound().count(), 0)
+        for payment in Payment.objects.all():
+            self.assertEqual(
+                sum(item.amount for item in payment.lineitems.all()), payment.amount
+            )
+
+    def test_balances(self):
+        s = apps.get_app_config("user_payments").settings
+
+        def balance():
+            b = Balance.objects.get(user=self.user)
+            return (b.open_amount, b.pending_amount, b.paid_amount, b.last_charged_at)
+
+        LineItem.objects.create(user=self.user, amount=5, title="Not maintained")
+        self.assertFalse(Balance.objects.exists())
+
+        with mock.patch.object(s, "maintain_balances", True):
+            with mock.patch.object(
+                Balance.objects, "refresh", wraps=Balance.objects.refresh
+            ) as refresh, self.captureOnCommitCallbacks(execute=True):
+                LineItem.objects.create(user=self.user, amount=3, title="Something")
+                payment = Payment.objects.create_pending(user=self.user)
+                LineItem.objects.create(user=self.user, amount=2, title="Else")
+            # Refreshed once per transaction
+            refresh.assert_called_once()
+            self.assertEqual(balance(), (2, 8, 0, None))
+
+            with self.captureOnCommitCallbacks(execute=True):
+                payment.charged_at = timezone.now()
+                payment.save()
+            self.assertEqual(balance(), (2, 0, 8, payment.charged_at))
+
+            with self.captureOnCommitCallbacks(execute=True):
+                payment.undo()
+            self.assertEqual(balance(), (10, 8, 0, None))
+
+            with self.captureOnCommitCallbacks(execute=True):
+                payment.cancel_pending()
+            self.assertEqual(balance(), (10, 0, 0, None))
+
+            with self.captureOnCommitCallbacks(execute=True):
+                list(Payment.objects.create_pending_bulk())
+            self.assertEqual(balance(), (0, 10, 0, None))
+
+        # Drift, e.g. caused by queryset updates
+        Payment.objects.update(charged_at=timezone.now())
+        self.assertEqual(balance(), (0, 10, 0, None))
+
+        call_command("rebuild_user_balances", stdout=io.StringIO())
+        self.assertEqual(balance()[:3], (0, 0, 10))
+
+        other = User.objects.create_user("other")
+        users = Balance.objects.annotate_users(User.objects.order_by("pk"))
+        self.assertEqual(
+            [(u, u.open_amount, u.paid_amount) for u in users],
+            [(self.user, 0, 10), (other, 0, 0)],
+        )
+
+    def test_metering(self):
+        buffer = LineItemBuffer(max_size=3, max_age=60)
+        buffer.add(user=self.user, title="Call", amount="0.05")
+        buffer.add(user=self.user.pk, title="Call", amount="0.05")
+        self.assertEqual(len(buffer), 2)
+        self.assertEqual(buffer.flush(force=False), 0)
+        self.assertEqual(LineItem.objects.count(), 0)
+
+        # Tests run inside a transaction, flushing waits for the commit
+        with self.captureOnCommitCallbacks(execute=True):
+            buffer.add(user=self.user, title="Call", amount="0.05")
+            self.assertEqual(len(buffer), 3)
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual(LineItem.objects.count(), 3)
+
+        buffer = LineItemBuffer(max_size=3, max_age=60, aggregate=True)
+        for _ in range(5):
+            buffer.add(user=self.user, title="Call", amount="0.05")
+        buffer.add(user=self.user, title="Other", amount=1)
+        self.assertEqual(len(buffer), 2)
+
+        with mock.patch.object(
+            LineItem.objects, "bulk_create", side_effect=DatabaseError
+        ):
+            with self.assertRaises(DatabaseError):
+                buffer.flush()
+        self.assertEqual(len(buffer), 2)
+
+        self.assertEqual(buffer.flush(), 2)
+        self.assertEqual(
+            {
+                (str(item), item.quantity, item.unit_amount, item.amount)
+                for item in LineItem.objects.exclude(title="Call", quantity=1)
+            },
+            {
+                ("Call (5×)", 5, Decimal("0.05"), Decimal("0.25")),
+                ("Other", 1, Decimal("1.00"), Decimal("1.00")),
+            },
+        )
+
+    def test_metering_rollback(self):
+        buffer = LineItemBuffer(max_size=2, max_age=60)
+        buffer.add(user=self.user, title="Outside", amount=1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(ZeroDivisionError), transaction.atomic():
+                buffer.add(user=self.user, title="Rolled back", amount=2)
+                1 / 0
+
+        # Nothing has been lost
+        self.assertEqual(LineItem.objects.count(), 0)
+        self.assertEqual(len(buffer), 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            buffer.add(user=self.user, title="Committed", amount=3)
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual(
+            sorted(LineItem.objects.values_list("title", flat=True)),
+            ["Committed", "Outside", "Rolled back"],
+        )
+
+    def test_metering_request_finished(self):
+        try:
+            with mock.patch.object(metering, "_buffer", None):
+                metering.meter(user=self.user, title="Call", amount="0.05")
+                self.assertEqual(LineItem.objects.count(), 0)
+
+                # Not due yet
+                self.login().get("/admin/")
+                self.assertEqual(LineItem.objects.count(), 0)
+
+                metering.get_buffer().max_age = 0
+                self.login().get("/admin/")
+                self.assertEqual(LineItem.objects.count(), 1)
+                self.assertEqual(metering.flush(), 0)
+        finally:
+            request_finished.disconnect(metering._request_finished)
+            atexit.unregister(metering.flush)
+
+    def test_increment(self):
+        item = LineItem.objects.create(user=self.user, amount=5, title="Legacy")
+        self.assertEqual((item.quantity, item.unit_amount), (1, 5))
+
+        item = LineItem.objects.create(
+            user=self.user, quantity=3, unit_amount=Decimal("0.10"), title="Calls"
+        )
+        self.assertEqual(item.amount, Decimal("0.30"))
+        self.assertEqual(str(item), "Calls (3×)")
+
+        # Editing the amount of an existing line item keeps the amount.
+        item = LineItem.objects.get(title="Legacy")
+        item.amount = 7
+        item.save()
+        item = LineItem.objects.get(title="Legacy")
+        self.assertEqual((item.quantity, item.unit_amount, item.amount), (1, 7, 7))
+
+        item = LineItem.objects.get(title="Calls")
+        item.amount = Decimal("0.60")
+        item.save()
+        self.assertEqual(item.unit_amount, Decimal("0.20"))
+        item.quantity = 4
+        item.save()
+        item.refresh_from_db()
+        self.assertEqual(
+            (item.unit_amount, item.amount), (Decimal("0.20"), Decimal("0.80"))
+        )
+        item.amount = 1
+        item.save()
+        self.assertEqual(LineItem.objects.get(pk=item.pk).amount, 1)
+        item.delete()
+
+        # Amounts set using update() are kept when saving other fields
+        LineItem.objects.filter(title="Legacy").update(amount=9)
+        item = LineItem.objects.get(title="Legacy")
+        item.title = "Legacy item"
+        item.save()
+        self.assertEqual(LineItem.objects.get(pk=item.pk).amount, 9)
+        item.title = "Legacy"
+        item.save()
+
+        def increment(quantity):
+            return LineItem.objects.increment(
+                self.user,
+                "api",
+                quantity,
+                title="API calls",
+                unit_amount=Decimal("0.05"),
+            )
+
+        self.assertTrue(increment(2))
+        with self.assertNumQueries(3):  # SAVEPOINT, UPDATE, RELEASE
+            self.assertFalse(increment(5))
+        item = LineItem.objects.get(key="api")
+        self.assertEqual((item.quantity, item.amount), (7, Decimal("0.35")))
+
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            LineItem.objects.create(
+                user=self.user, key="api", title="Duplicate", amount=1
+            )
+
+        payment = Payment.objects.create_pending(user=self.user)
+        self.assertEqual(payment.amount, Decimal("9.35"))
+        self.assertIn("API calls (7×)", payment.description)
+
+        # Bound line items are not incremented anymore
+        self.assertTrue(increment(1))
+        self.assertEqual(LineItem.objects.filter(key="api").count(), 2)
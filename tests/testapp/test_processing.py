@@ -1,18 +1,27 @@
+import asyncio
+import threading
 from datetime import timedelta
 from unittest import mock
 
 import stripe
+from asgiref.sync import async_to_sync
+from django.apps import apps
 from django.contrib.auth.models import User
 from django.core import mail
-from django.test import TestCase
+from django.db import connections, transaction
+from django.test import TestCase, TransactionTestCase
 from django.utils import timezone
 from django.utils.translation import deactivate_all
 from testapp.processing import processors
 
+from user_payments.instrumentation import Instrument, export_statsd
 from user_payments.models import LineItem, Payment
 from user_payments.processing import (
     Result,
     ResultError,
+    aprocess_payment,
+    aprocess_pending_payments,
+    aprocess_unbound_items,
     process_payment,
     process_pending_payments,
     process_unbound_items,
@@ -32,7 +41,7 @@ class Test(TestCase):
         )
 
         Customer.objects.create(
-            user=item.user, customer_id="cus_example", customer_data="{}"
+            user=item.user, customer_id="cus_example", customer_data={}
         )
 
         LineItem.objects.create(
@@ -53,6 +62,211 @@ class Test(TestCase):
         self.assertTrue(payment.charged_at is not None)
         self.assertEqual(payment.user, item.user)
 
+    def test_processing_bulk(self):
+        for i in range(3):
+            user = User.objects.create(username=f"test{i}", email=f"test{i}@a.com")
+            LineItem.objects.create(user=user, amount=5, title="Stuff")
+            LineItem.objects.create(user=user, amount=10, title="More stuff")
+            if i:
+                Customer.objects.create(
+                    user=user, customer_id=f"cus_example{i}", customer_data={}
+                )
+
+        with mock.patch.object(stripe.Charge, "create", return_value={"success": True}):
+            stats = process_unbound_items(
+                processors=processors, bulk=True, chunk_size=2
+            )
+
+        self.assertEqual(stats.payments, 3)
+        self.assertEqual(stats.succeeded, 2)
+        self.assertTrue(stats.queries > 0)
+        self.assertEqual(len(mail.outbox), 1)
+
+        self.assertEqual(LineItem.objects.unbound().count(), 2)
+        self.assertEqual(LineItem.objects.unpaid().count(), 2)
+        self.assertEqual(
+            sorted(payment.amount for payment in Payment.objects.all()), [15, 15]
+        )
+
+    def test_pending_payments_chunks(self):
+        payments = []
+        for i in range(5):
+            user = User.objects.create(username=f"test{i}", email=f"test{i}@a.com")
+            Customer.objects.create(
+                user=user, customer_id=f"cus_example{i}", customer_data={}
+            )
+            LineItem.objects.create(user=user, amount=5, title="Stuff")
+            payments.append(Payment.objects.create_pending(user=user))
+        payments.sort(key=lambda payment: payment.pk)
+
+        seen = []
+
+        def record(payment):
+            self.assertEqual(
+                payment.get_deferred_fields(), {"transaction"}
+            )  # Large columns are not loaded
+            self.assertEqual(
+                payment.user.stripe_customer.get_deferred_fields(), {"customer_data"}
+            )
+            seen.append(payment.pk)
+            return Result.FAILURE
+
+        stats = process_pending_payments(
+            processors=[record], chunk_size=2, after=payments[0].pk
+        )
+        self.assertEqual(stats.payments, 4)
+        self.assertEqual(seen, [payment.pk for payment in payments[1:]])
+        # Nothing has been canceled
+        self.assertEqual(Payment.objects.pending().count(), 5)
+
+        # Three chunks with their line items, one empty chunk and no
+        # additional queries
+        with self.assertNumQueries(7):
+            process_pending_payments(
+                processors=[lambda p: Result.FAILURE], chunk_size=2
+            )
+
+    def test_instrumentation(self):
+        for i in range(3):
+            user = User.objects.create(username=f"test{i}", email=f"test{i}@a.com")
+            LineItem.objects.create(user=user, amount=5, title="Stuff")
+            if i:
+                Customer.objects.create(
+                    user=user, customer_id=f"cus_example{i}", customer_data={}
+                )
+
+        events = []
+
+        class Recorder(Instrument):
+            def processor_called(self, *, payment, processor, result, seconds):
+                events.append((processor.__name__, result))
+
+            def batch_processed(self, *, name, stats, seconds):
+                events.append((name, stats.payments))
+
+        with mock.patch.object(stripe.Charge, "create", return_value={"success": True}):
+            stats = process_unbound_items(
+                processors=processors, workers=1, instrument=Recorder()
+            )
+
+        self.assertEqual(
+            events,
+            [
+                ("with_stripe_customer", Result.FAILURE),
+                ("please_pay_mail", Result.FAILURE),
+                ("with_stripe_customer", Result.SUCCESS),
+                ("with_stripe_customer", Result.SUCCESS),
+                ("process_unbound_items", 3),
+            ],
+        )
+
+        summary = stats.summary
+        self.assertEqual(
+            summary.results,
+            {
+                "with_stripe_customer": {"SUCCESS": 2, "FAILURE": 1},
+                "please_pay_mail": {"FAILURE": 1},
+            },
+        )
+        self.assertEqual(summary.payments, 3)
+        self.assertEqual(summary.succeeded, 2)
+        self.assertEqual(summary.processor_latency["with_stripe_customer"].count, 3)
+        self.assertEqual(summary.payment_latency.cumulative()[-1], (float("inf"), 3))
+        self.assertEqual(
+            [name for name, _ in summary.batches], ["process_unbound_items"]
+        )
+
+        lines = []
+        export_statsd(summary, lines.append, prefix="pay")
+        self.assertEqual(
+            lines[:5],
+            [
+                "pay.payments:3|c",
+                "pay.payments.succeeded:2|c",
+                "pay.processor.please_pay_mail.failure:1|c",
+                "pay.processor.with_stripe_customer.failure:1|c",
+                "pay.processor.with_stripe_customer.success:2|c",
+            ],
+        )
+        self.assertIn("pay.processor.with_stripe_customer.latency.count:3|c", lines)
+        self.assertTrue(lines[-1].startswith("pay.batch.process_unbound_items:"))
+        self.assertIn("pay.payment.latency.count:3|c", lines)
+        self.assertEqual(
+            sum(
+                int(line.split(":")[1].split("|")[0])
+                for line in lines
+                if line.startswith("pay.payment.latency.le_")
+            ),
+            3,
+        )
+
+    def test_processing_workers(self):
+        for i in range(3):
+            user = User.objects.create(username=f"test{i}", email=f"test{i}@a.com")
+            LineItem.objects.create(user=user, amount=5, title="Stuff")
+            if i:
+                Customer.objects.create(
+                    user=user, customer_id=f"cus_example{i}", customer_data={}
+                )
+
+        with mock.patch.object(stripe.Charge, "create", return_value={"success": True}):
+            stats = process_unbound_items(processors=processors, workers=1)
+
+        self.assertEqual(stats.payments, 3)
+        self.assertEqual(stats.succeeded, 2)
+        self.assertEqual(len(stats.workers), 1)
+        self.assertEqual(stats.workers[0].payments, 3)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(LineItem.objects.unbound().count(), 1)
+        self.assertEqual(Payment.objects.pending().count(), 0)
+
+        # Pending payments are not canceled
+        Payment.objects.create_pending(user=User.objects.get(username="test0"))
+        stats = process_pending_payments(processors=processors, workers=1)
+        self.assertEqual(stats.payments, 1)
+        self.assertEqual(stats.succeeded, 0)
+        self.assertEqual(Payment.objects.pending().count(), 1)
+
+    def test_async_processing(self):
+        for i in range(4):
+            user = User.objects.create(username=f"test{i}", email=f"test{i}@a.com")
+            LineItem.objects.create(user=user, amount=5 + i, title="Stuff")
+
+        charged = []
+
+        async def charge_odd(payment):
+            await asyncio.sleep(0)
+            if payment.amount % 2:
+                return Result.FAILURE
+            charged.append(payment.email)
+            return Result.SUCCESS
+
+        stats = async_to_sync(aprocess_unbound_items)(
+            processors=[charge_odd, processors[-1]], bulk=True, concurrency=2
+        )
+
+        self.assertEqual(stats.payments, 4)
+        self.assertEqual(stats.succeeded, 2)
+        self.assertEqual(sorted(charged), ["test1@a.com", "test3@a.com"])
+        # Please pay mails for the two failing payments
+        self.assertEqual(len(mail.outbox), 2)
+        # Failed payments have been canceled
+        self.assertEqual(Payment.objects.count(), 2)
+        self.assertEqual(LineItem.objects.unbound().count(), 2)
+
+        stats = async_to_sync(aprocess_pending_payments)(processors=[charge_odd])
+        self.assertEqual(stats.payments, 2)
+        self.assertEqual(stats.succeeded, 2)
+
+    def test_async_invalid_result(self):
+        async def fail(payment):
+            return None  # Invalid return value
+
+        with self.assertRaises(ResultError):
+            async_to_sync(aprocess_payment)(
+                Payment(), processors=[fail], cancel_on_failure=False
+            )
+
     def test_refresh(self):
         item = LineItem.objects.create(
             user=User.objects.create(username="test1", email="test1@example.com"),
@@ -61,7 +275,7 @@ class Test(TestCase):
         )
 
         Customer.objects.create(
-            user=item.user, customer_id="cus_example", customer_data="{}"
+            user=item.user, customer_id="cus_example", customer_data={}
         )
 
         Customer.objects.update(updated_at=timezone.now() - timedelta(days=60))
@@ -75,6 +289,28 @@ class Test(TestCase):
         customer = Customer.objects.get()
         self.assertEqual(customer.customer, {"marker": True})
 
+    def test_no_refresh_on_charge(self):
+        item = LineItem.objects.create(
+            user=User.objects.create(username="test1", email="test1@example.com"),
+            amount=5,
+            title="Stuff",
+        )
+        Customer.objects.create(
+            user=item.user, customer_id="cus_example", customer_data={}
+        )
+        Customer.objects.update(updated_at=timezone.now() - timedelta(days=60))
+
+        s = apps.get_app_config("stripe_customers").settings
+        with mock.patch.object(s, "refresh_on_charge", False):
+            with mock.patch.object(
+                stripe.Charge, "create", return_value={"success": True}
+            ):
+                with mock.patch.object(stripe.Customer, "retrieve") as retrieve:
+                    process_unbound_items(processors=processors)
+
+        self.assertEqual(retrieve.call_count, 0)
+        self.assertTrue(Payment.objects.get().charged_at is not None)
+
     def test_card_error(self):
         item = LineItem.objects.create(
             user=User.objects.create(username="test1", email="test1@example.com"),
@@ -82,7 +318,7 @@ class Test(TestCase):
             title="Stuff",
         )
         Customer.objects.create(
-            user=item.user, customer_id="cus_example", customer_data="{}"
+            user=item.user, customer_id="cus_example", customer_data={}
         )
 
         with mock.patch.object(
@@ -127,7 +363,7 @@ class Test(TestCase):
             title="Stuff",
         )
         Customer.objects.create(
-            user=item.user, customer_id="cus_example", customer_data="{}"
+            user=item.user, customer_id="cus_example", customer_data={}
         )
         Payment.objects.create_pending(user=item.user)
 
@@ -156,3 +392,117 @@ class Test(TestCase):
         with self.assertRaises(ResultError):
             if Result.SUCCESS:
                 pass
+
+
+class ConcurrencyTest(TransactionTestCase):
+    def setUp(self):
+        deactivate_all()
+
+    def test_workers(self):
+        for i in range(6):
+            user = User.objects.create(username=f"test{i}", email=f"test{i}@a.com")
+            LineItem.objects.create(user=user, amount=5, title="Stuff")
+            Payment.objects.create_pending(user=user)
+
+        processed = []
+
+        def succeed(payment):
+            # SQLite's shared cache does not allow concurrent writers, so
+            # only record the payment instead of saving it.
+            processed.append(payment.pk)
+            return Result.SUCCESS
+
+        stats = process_pending_payments(processors=[succeed], workers=3)
+
+        self.assertEqual(stats.payments, 6)
+        self.assertEqual(stats.succeeded, 6)
+        self.assertEqual(len(stats.workers), 3)
+        self.assertEqual(sum(worker.payments for worker in stats.workers), 6)
+        self.assertEqual(
+            sorted(processed), sorted(Payment.objects.values_list("pk", flat=True))
+        )
+
+    def test_async_sync_processor_connections(self):
+        for i in range(6):
+            user = User.objects.create(username=f"test{i}", email=f"test{i}@a.com")
+            LineItem.objects.create(user=user, amount=5, title="Stuff")
+            Payment.objects.create_pending(user=user)
+
+        used = []
+
+        def succeed(payment):
+            self.assertTrue(Payment.objects.filter(pk=payment.pk).exists())
+            used.append(connections["default"])
+            return Result.SUCCESS
+
+        wrapper = type(connections["default"])
+        # SQLite does not really close in-memory databases, record calls
+        with mock.patch.object(
+            wrapper, "close", autospec=True, side_effect=wrapper.close
+        ) as close:
+            stats = async_to_sync(aprocess_pending_payments)(
+                processors=[succeed], concurrency=2
+            )
+        self.assertEqual(stats.succeeded, 6)
+        self.assertEqual(len(used), 6)
+        # At most one connection per executor thread, closed once at the end
+        self.assertNotIn(connections["default"], used)
+        self.assertLessEqual(len(set(used)), 2)
+        closed = [call.args[0] for call in close.call_args_list]
+        self.assertTrue(all(closed.count(conn) == 1 for conn in set(used)))
+
+        # Without an executor the connection is closed after each call
+        payment = Payment.objects.first()
+        with mock.patch.object(
+            wrapper, "close", autospec=True, side_effect=wrapper.close
+        ) as close:
+            async_to_sync(aprocess_payment)(
+                payment, processors=[succeed, succeed], cancel_on_failure=False
+            )
+        self.assertEqual(close.call_count, 1)
+
+    def test_single_worker_in_thread(self):
+        user = User.objects.create(username="test", email="test@a.com")
+        LineItem.objects.create(user=user, amount=5, title="Stuff")
+        Payment.objects.create_pending(user=user)
+
+        def succeed(payment):
+            return Result.SUCCESS
+
+        results = []
+        wrapper = type(connections["default"])
+
+        def run():
+            try:
+                with transaction.atomic():
+                    stats = process_pending_payments(processors=[succeed], workers=1)
+                    # The caller's connection has not been closed
+                    results.append((stats.succeeded, close.call_count))
+            finally:
+                connections.close_all()
+
+        # SQLite does not really close in-memory databases, record calls
+        with mock.patch.object(
+            wrapper, "close", autospec=True, side_effect=wrapper.close
+        ) as close:
+            thread = threading.Thread(target=run)
+            thread.start()
+            thread.join()
+        self.assertEqual(results, [(1, 0)])
+
+    def test_workers_exception(self):
+        user = User.objects.create(username="test", email="test@a.com")
+        LineItem.objects.create(user=user, amount=5, title="Stuff")
+
+        class SomeException(Exception):
+            pass
+
+        def fail(payment):
+            raise SomeException()
+
+        with self.assertRaises(SomeException):
+            process_unbound_items(processors=[fail], workers=2)
+
+        # The payment has been canceled nevertheless
+        self.assertEqual(Payment.objects.count(), 0)
+        self.assertEqual(LineItem.objects.unbound().count(), 1)
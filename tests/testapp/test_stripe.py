@@ -1,13 +1,22 @@
 import json
 import os
+import threading
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
 from unittest import mock
+from urllib.parse import parse_qs
 
 import stripe
+from django.apps import apps
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.management import call_command
 from django.test import Client, TestCase
+from django.utils import timezone
 from django.utils.translation import deactivate_all
 
+from user_payments.stripe_customers.http import create_charges, pooled_http_client
 from user_payments.stripe_customers.models import Customer
 
 
@@ -15,13 +24,49 @@ class AttrDict(dict):
     """Dictionary which also allows attribute access to its items"""
 
     def __getattr__(self, key):
-        return self[key]
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
 
     def save(self):
         # stripe.Customer.save()
         pass
 
 
+class StubStripeHandler(BaseHTTPRequestHandler):
+    """Answers charge requests and records the client port of each request"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = parse_qs(self.rfile.read(int(self.headers["Content-Length"])).decode())
+        self.server.ports.append(self.client_address[1])
+        if body["customer"] == ["cus_declined"]:
+            status, data = 402, {
+                "error": {
+                    "type": "card_error",
+                    "code": "card_declined",
+                    "message": "Your card was declined.",
+                }
+            }
+        else:
+            status, data = 200, {
+                "id": f"ch_{len(self.server.ports)}",
+                "object": "charge",
+                "amount": int(body["amount"][0]),
+            }
+        content = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
 class Test(TestCase):
     def setUp(self):
         self.user = User.objects.create_superuser("admin", "admin@test.ch", "blabla")
@@ -57,6 +102,9 @@ class Test(TestCase):
         )
         self.assertNotContains(response, "cus_BdO5X6Bj123456")
 
+        response = client.get("/admin/stripe_customers/customer/")
+        self.assertContains(response, "4/2024")
+
     def test_property(self):
 
         with mock.patch.object(stripe.Customer, "retrieve", return_value={"bla": 3}):
@@ -64,18 +112,18 @@ class Test(TestCase):
                 customer_id="cus_1234567890", user=self.user
             )
 
-        self.assertEqual(customer.customer_data, '{"bla": 3}')
+        self.assertEqual(customer.customer_data, {"bla": 3})
         self.assertEqual(str(customer), "cus_123456****")
 
         customer = Customer.objects.get()
-        self.assertEqual(customer.customer_data, '{"bla": 3}')
+        self.assertEqual(customer.customer_data, {"bla": 3})
         self.assertEqual(customer.customer, {"bla": 3})
 
-        cache = customer.customer
-        cache["test"] = 5
+        data = customer.customer
+        data["test"] = 5
 
-        self.assertEqual(customer.customer_data, '{"bla": 3}')
         self.assertEqual(customer.customer, {"bla": 3, "test": 5})
+        self.assertEqual(Customer.objects.get().customer, {"bla": 3})
 
         # Change is serialized when calling .save()
         customer.save()
@@ -87,7 +135,7 @@ class Test(TestCase):
             Customer(customer_id="cus_1234567890", user=self.user).refresh()
 
         customer = Customer.objects.get()
-        self.assertEqual(customer.customer_data, '{"bla": 3}')
+        self.assertEqual(customer.customer_data, {"bla": 3})
         self.assertEqual(customer.customer, {"bla": 3})
 
     def test_with_token_create(self):
@@ -95,6 +143,21 @@ class Test(TestCase):
             customer = Customer.objects.with_token(user=self.user, token="bla")
         self.assertEqual(customer.customer_id, "cus_BdO5X6Bj123456")
 
+        # Card data is extracted from the default source
+        customer = Customer.objects.defer("customer_data").get()
+        self.assertEqual(
+            (
+                customer.card_brand,
+                customer.card_last4,
+                customer.card_exp_month,
+                customer.card_exp_year,
+            ),
+            ("Visa", "4242", 4, 2024),
+        )
+        self.assertEqual(
+            Customer.objects.filter(card_exp_year__lte=2024).get(), customer
+        )
+
     def test_with_token_update(self):
         with mock.patch.object(stripe.Customer, "retrieve", return_value=self.data):
             c1 = Customer.objects.create(
@@ -103,3 +166,82 @@ class Test(TestCase):
             customer = Customer.objects.with_token(user=self.user, token="bla")
         self.assertEqual(customer.customer_id, "cus_BdO5X6Bj123456")
         self.assertEqual(c1.pk, customer.pk)
+
+    def test_refresh_stale(self):
+        for i in range(5):
+            Customer.objects.create(
+                user=User.objects.create(username=f"user{i}"),
+                customer_id=f"cus_{i}",
+                customer_data={},
+            )
+        Customer.objects.filter(customer_id__in=["cus_1", "cus_2", "cus_3"]).update(
+            updated_at=timezone.now() - timedelta(days=31)
+        )
+        self.assertFalse(Customer.objects.get(customer_id="cus_0").needs_refresh)
+        self.assertTrue(Customer.objects.get(customer_id="cus_1").needs_refresh)
+        self.assertEqual(Customer.objects.stale().count(), 3)
+
+        def retrieve(customer_id, **kwargs):
+            if customer_id == "cus_2":
+                raise stripe.error.InvalidRequestError("No such customer", "id")
+            return {"id": customer_id}
+
+        with mock.patch.object(stripe.Customer, "retrieve", side_effect=retrieve):
+            stdout = StringIO()
+            call_command(
+                "refresh_stripe_customers", chunk_size=2, workers=2, stdout=stdout
+            )
+
+        self.assertEqual(stdout.getvalue(), "Refreshed 2 customers.\n")
+        self.assertEqual(
+            list(Customer.objects.stale().values_list("customer_id", flat=True)),
+            ["cus_2"],
+        )
+        self.assertEqual(
+            Customer.objects.get(customer_id="cus_3").customer, {"id": "cus_3"}
+        )
+
+    def test_default_http_client(self):
+        config = apps.get_app_config("stripe_customers")
+
+        # Clients configured by the project are kept
+        client = stripe.http_client.RequestsClient()
+        with mock.patch.object(stripe, "default_http_client", client):
+            config.ready()
+            self.assertIs(stripe.default_http_client, client)
+
+        with mock.patch.object(stripe, "default_http_client", None):
+            config.ready()
+            self.assertIsInstance(
+                stripe.default_http_client, stripe.http_client.RequestsClient
+            )
+            self.assertIsNot(stripe.default_http_client, client)
+
+    def test_pooled_http_client(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), StubStripeHandler)
+        server.ports = []
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        client = pooled_http_client(pool_size=2, timeout=5)
+        with mock.patch.object(
+            stripe, "api_base", "http://127.0.0.1:%s" % server.server_port
+        ), mock.patch.object(stripe, "default_http_client", client):
+            results = create_charges(
+                [
+                    {"customer": "cus_declined" if i == 3 else "cus_ok", "amount": i}
+                    for i in range(10)
+                ],
+                workers=2,
+            )
+
+        self.assertEqual(len(server.ports), 10)
+        # Connections have been kept alive and reused
+        self.assertLessEqual(len(set(server.ports)), 2)
+        self.assertIsInstance(results[3], stripe.error.CardError)
+        self.assertEqual(
+            [result["amount"] for i, result in enumerate(results) if i != 3],
+            [0, 1, 2, 4, 5, 6, 7, 8, 9],
+        )
@@ -1,10 +1,17 @@
-from datetime import date
+from datetime import date, timedelta
 from itertools import islice
 
 from django.test import TestCase
 
 from user_payments.exceptions import UnknownPeriodicity
-from user_payments.user_subscriptions.utils import next_valid_day, recurring
+from user_payments.user_subscriptions.utils import (
+    count_occurrences,
+    index_after,
+    next_valid_day,
+    occurrence,
+    recurring,
+    schedule,
+)
 
 
 class Test(TestCase):
@@ -68,3 +75,54 @@ class Test(TestCase):
 
         with self.assertRaises(UnknownPeriodicity):
             list(islice(recurring(date(2016, 1, 1), "unknown"), 5))
+
+    def test_seeking(self):
+        self.assertEqual(occurrence(date(2016, 2, 29), "yearly", 4), date(2020, 2, 29))
+        self.assertEqual(occurrence(date(2018, 3, 31), "monthly", 1), date(2018, 5, 1))
+        self.assertEqual(occurrence(date(2016, 1, 1), "weekly", 52), date(2016, 12, 30))
+
+        for start in [date(2016, 1, 31), date(2016, 2, 29), date(2017, 12, 30)]:
+            for periodicity in ["yearly", "quarterly", "monthly", "weekly"]:
+                dates = list(islice(recurring(start, periodicity), 60))
+                self.assertEqual(
+                    [occurrence(start, periodicity, i) for i in range(60)], dates
+                )
+
+                day = start - timedelta(days=3)
+                while day < dates[-2]:
+                    index = index_after(start, periodicity, day)
+                    self.assertTrue(dates[index] > day)
+                    self.assertTrue(index == 0 or dates[index - 1] <= day)
+                    self.assertEqual(
+                        next(recurring(start, periodicity, after=day)), dates[index]
+                    )
+                    self.assertEqual(
+                        count_occurrences(start, periodicity, day, dates[-2]),
+                        len([d for d in dates if day <= d <= dates[-2]]),
+                    )
+                    day += timedelta(days=5)
+
+        self.assertEqual(
+            count_occurrences(
+                date(2016, 1, 1), "weekly", date(2017, 1, 1), date(2016, 1, 1)
+            ),
+            0,
+        )
+
+        with self.assertRaises(UnknownPeriodicity):
+            index_after(date(2016, 1, 1), "manually", date(2017, 1, 1))
+
+    def test_schedule(self):
+        schedule.cache_clear()
+
+        days = schedule(date(2016, 1, 31), "monthly", date(2016, 3, 31))
+        self.assertEqual(
+            [date.fromordinal(day) for day in days],
+            [date(2016, 1, 31), date(2016, 3, 1), date(2016, 3, 31), date(2016, 5, 1)],
+        )
+        self.assertIs(schedule(date(2016, 1, 31), "monthly", date(2016, 3, 31)), days)
+        info = schedule.cache_info()
+        self.assertEqual((info.hits, info.misses), (1, 1))
+
+        with self.assertRaises(UnknownPeriodicity):
+            schedule(date(2016, 1, 1), "manually", date(2017, 1, 1))
@@ -1,12 +1,23 @@
+import io
 from datetime import date, timedelta
+from unittest import mock
 
+from django.apps import apps
 from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
 from django.test import Client, TestCase
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from django.utils.translation import deactivate_all
 
-from user_payments.models import LineItem, Payment
-from user_payments.user_subscriptions.models import Subscription, SubscriptionPeriod
+from user_payments.models import Balance, LineItem, Payment
+from user_payments.user_subscriptions.models import (
+    Subscription,
+    SubscriptionPeriod,
+    defer_paid_until_updates,
+)
+from user_payments.user_subscriptions.utils import occurrence, schedule
 
 
 def zero_management_form_data(prefix):
@@ -107,6 +118,72 @@ class Test(TestCase):
         self.assertTrue(subscription.is_active)
         self.assertFalse(subscription.in_grace_period)
 
+    def test_active(self):
+        subscription = Subscription.objects.create(
+            user=self.user,
+            code="test2",
+            title="Test subscription 2",
+            periodicity="monthly",
+            amount=0,
+            starts_on=date.today() - timedelta(days=60),
+        )
+        self.assertEqual(
+            subscription.grace_period_ends_at,
+            subscription.paid_until_at + timedelta(days=7),
+        )
+        self.assertFalse(subscription.is_active)
+        self.assertFalse(self.user.user_subscriptions.active().exists())
+
+        # The payment_changed signal handler updates the denormalized field
+        for period in subscription.create_periods():
+            self.pay_period(period)
+
+        subscription.refresh_from_db()
+        self.assertTrue(subscription.grace_period_ends_at > timezone.now())
+        self.assertTrue(subscription.is_active)
+        self.assertEqual(
+            self.user.user_subscriptions.active().for_code("test2"), subscription
+        )
+
+        # Unsaved instances do not have a grace_period_ends_at value yet
+        unsaved = Subscription(
+            user=self.user, paid_until=date.today() - timedelta(days=3)
+        )
+        self.assertIsNone(unsaved.grace_period_ends_at)
+        self.assertTrue(unsaved.is_active)
+        self.assertTrue(unsaved.in_grace_period)
+        unsaved.paid_until = date.today() - timedelta(days=10)
+        self.assertFalse(unsaved.is_active)
+        self.assertFalse(unsaved.in_grace_period)
+
+    def test_update_grace_period_ends_at(self):
+        for code in ["a", "b", "c"]:
+            Subscription.objects.create(
+                user=self.user,
+                code=code,
+                title=code,
+                periodicity="monthly",
+                amount=0,
+                starts_on=date.today() - timedelta(days=3),
+            )
+        subscriptions = Subscription.objects.filter(code__in=["a", "b", "c"])
+        settings = apps.get_app_config("user_payments").settings
+
+        with mock.patch.object(settings, "grace_period", timedelta(days=1)):
+            # The stored values still use the old grace period
+            self.assertFalse(subscriptions[0].is_active)
+            self.assertEqual(subscriptions.active().count(), 3)
+
+            self.assertEqual(subscriptions.update_grace_period_ends_at(), 3)
+            self.assertEqual(subscriptions.active().count(), 0)
+            self.assertEqual(subscriptions.update_grace_period_ends_at(), 0)
+
+        stdout = io.StringIO()
+        call_command("update_grace_periods", chunk_size=2, stdout=stdout)
+        self.assertEqual(stdout.getvalue(), "Updated 3 subscriptions.\n")
+        self.assertEqual(subscriptions.active().count(), 3)
+        self.assertTrue(subscriptions[0].is_active)
+
     def test_ends_on(self):
         subscription = Subscription.objects.create(
             user=self.user,
@@ -208,6 +285,135 @@ class Test(TestCase):
             ["sub1"],
         )
 
+    def test_manager_create_periods_batch(self):
+        first = Subscription.objects.create(
+            user=self.user,
+            code="sub1",
+            periodicity="weekly",
+            amount=10,
+            starts_on=date(2018, 1, 1),
+        )
+        first.create_periods(until=date(2018, 1, 14))
+        Subscription.objects.create(
+            user=self.user,
+            code="sub2",
+            periodicity="monthly",
+            amount=10,
+            starts_on=date(2018, 1, 31),
+        )
+
+        stats = Subscription.objects.create_periods(
+            until=date(2018, 3, 31), chunk_size=1
+        )
+        self.assertEqual(stats.subscriptions, 2)
+        self.assertEqual(stats.periods, 11 + 3)
+        self.assertEqual(
+            [
+                (p.starts_on, p.ends_on)
+                for p in SubscriptionPeriod.objects.filter(
+                    subscription__code="sub2"
+                ).order_by("starts_on")
+            ],
+            [
+                (date(2018, 1, 31), date(2018, 2, 28)),
+                (date(2018, 3, 1), date(2018, 3, 30)),
+                (date(2018, 3, 31), date(2018, 4, 30)),
+            ],
+        )
+        self.assertEqual(first.periods.count(), 13)
+
+        schedule.cache_clear()
+        stats = Subscription.objects.create_periods(until=date(2018, 3, 31))
+        self.assertEqual(stats.periods, 0)
+        # Subscriptions with periods seek to the first missing period
+        self.assertEqual(schedule.cache_info().misses, 0)
+        schedule(date(2018, 1, 1), "weekly", date(2018, 3, 31))
+        self.assertEqual(SubscriptionPeriod.objects.count(), 16)
+
+        Subscription.objects.create(
+            user=User.objects.create(username="other"),
+            code="sub1",
+            periodicity="weekly",
+            amount=10,
+            starts_on=date(2018, 1, 1),
+        )
+        stats = Subscription.objects.create_periods(until=date(2018, 3, 31))
+        self.assertEqual(stats.periods, 13)
+        # The schedule of the new subscription has been cached already
+        self.assertEqual(schedule.cache_info().misses, 1)
+        self.assertEqual(SubscriptionPeriod.objects.count(), 16 + 13)
+
+        # Periods inserted concurrently are skipped, but counted
+        missing_periods = Subscription._missing_periods
+
+        def all_periods(self, *, latest_ends_on, until=None):
+            return missing_periods(self, latest_ends_on=None, until=until)
+
+        with mock.patch.object(Subscription, "_missing_periods", all_periods):
+            stats = Subscription.objects.create_periods(until=date(2018, 3, 31))
+        self.assertEqual(stats.periods, 16 + 13)
+        self.assertEqual(SubscriptionPeriod.objects.count(), 16 + 13)
+
+        # Long histories are not walked when creating the next period
+        subscription = Subscription.objects.create(
+            user=self.user,
+            code="old",
+            periodicity="weekly",
+            amount=10,
+            starts_on=date(2000, 1, 3),
+        )
+        SubscriptionPeriod.objects.create(
+            subscription=subscription,
+            starts_on=date(2018, 3, 19),
+            ends_on=date(2018, 3, 25),
+        )
+        with mock.patch(
+            "user_payments.user_subscriptions.models.occurrence", wraps=occurrence
+        ) as calls:
+            periods = subscription.create_periods(until=date(2018, 4, 2))
+        self.assertEqual(
+            [(p.starts_on, p.ends_on) for p in periods],
+            [
+                (date(2018, 3, 26), date(2018, 4, 1)),
+                (date(2018, 4, 2), date(2018, 4, 8)),
+            ],
+        )
+        self.assertEqual(calls.call_count, 3)
+
+    def test_manager_create_line_items(self):
+        subscription = Subscription.objects.create(
+            user=self.user,
+            code="sub1",
+            title="Sub",
+            periodicity="monthly",
+            amount=10,
+            starts_on=date(2018, 1, 1),
+        )
+        subscription.create_periods(until=date(2018, 3, 1))
+        subscription.periods.earliest().create_line_item()
+
+        self.assertEqual(
+            SubscriptionPeriod.objects.create_line_items(
+                until=date(2018, 3, 1), chunk_size=1
+            ),
+            2,
+        )
+        self.assertEqual(
+            SubscriptionPeriod.objects.create_line_items(until=date(2018, 3, 1)), 0
+        )
+        self.assertEqual(
+            sorted(
+                (period.line_item.title, period.line_item.amount, period.line_item.user)
+                for period in subscription.periods.select_related("line_item")
+            ),
+            [
+                ("Sub (2018-01-01 - 2018-01-31)", 10, self.user),
+                ("Sub (2018-02-01 - 2018-02-28)", 10, self.user),
+                ("Sub (2018-03-01 - 2018-03-31)", 10, self.user),
+            ],
+        )
+        self.assertEqual(LineItem.objects.count(), 3)
+
     def test_admin_create(self):
         client = self.login()
         response = client.post(
@@ -270,11 +476,36 @@ class Test(TestCase):
         self.assertEqual(period.line_item.amount, 60)
 
         subscription.amount = 100
-        subscription.save()
+        with self.assertNumQueries(2):
+            subscription.save()
+        self.assertEqual(subscription.last_save_steps, ["line_item_amounts"])
 
         period.line_item.refresh_from_db()
         self.assertEqual(period.line_item.amount, 100)
 
+        # Saving without changing the amount does not touch line items
+        subscription = Subscription.objects.get(pk=subscription.pk)
+        subscription.title = "Changed"
+        with self.assertNumQueries(1):
+            subscription.save()
+        self.assertEqual(subscription.last_save_steps, [])
+
+        with self.assertNumQueries(2):
+            subscription.update_paid_until()
+        self.assertEqual(subscription.last_save_steps, [])
+
+        # Deferred amounts are not loaded and not propagated
+        subscription = Subscription.objects.defer("amount").get(pk=subscription.pk)
+        with self.assertNumQueries(1):
+            subscription.save(update_fields=["title"])
+        self.assertEqual(subscription.last_save_steps, [])
+
+        subscription.amount = 120
+        subscription.save(update_fields=["amount"])
+        self.assertEqual(subscription.last_save_steps, ["line_item_amounts"])
+        period.line_item.refresh_from_db()
+        self.assertEqual(period.line_item.amount, 120)
+
     def test_ensure(self):
         subscription = Subscription.objects.ensure(
             user=self.user,
@@ -356,6 +587,73 @@ class Test(TestCase):
         self.assertEqual(subscription.periods.count(), 1)
         self.assertEqual(subscription.starts_on, date.today())
 
+    def test_ensure_many(self):
+        users = [
+            User.objects.create(username=f"user{i}", email=f"user{i}@example.com")
+            for i in range(3)
+        ]
+        plan = {"title": "Plan", "periodicity": "monthly", "amount": 60}
+
+        subscription = Subscription.objects.create(
+            user=users[0], code="plan", starts_on=date(2018, 1, 1), **plan
+        )
+        periods = subscription.create_periods(until=date(2018, 3, 1))
+        self.pay_period(periods[0], user=users[0])
+        # Pending and unbound periods are removed when changing
+        periods[1].create_line_item()
+        Payment.objects.create_pending(user=users[0])
+        periods[2].create_line_item()
+
+        Subscription.objects.create(
+            user=users[1], code="plan", starts_on=date(2018, 1, 1), **plan
+        )
+
+        results = Subscription.objects.ensure_many(
+            [
+                {"user": users[0], "code": "plan", **plan, "amount": 90},
+                {"user": users[1], "code": "plan", **plan},
+                {"user": users[2], "code": "plan", **plan},
+            ]
+        )
+        self.assertEqual(
+            [(s.user, outcome) for s, outcome in results],
+            [(users[0], "changed"), (users[1], "unchanged"), (users[2], "created")],
+        )
+
+        subscription.refresh_from_db()
+        self.assertEqual(subscription.amount, 90)
+        self.assertEqual(subscription.paid_until, date(2018, 1, 31))
+        self.assertEqual(subscription.periods.get(), periods[0])
+        self.assertEqual(Payment.objects.count(), 1)
+        self.assertEqual(LineItem.objects.count(), 1)
+
+        created = Subscription.objects.get(user=users[2])
+        self.assertEqual(created.starts_on, date.today())
+        self.assertEqual(created.paid_until, date.today() - timedelta(days=1))
+        self.assertIsNotNone(created.grace_period_ends_at)
+
+        # Subscriptions which are still paid for start later
+        subscription.paid_until = date(2040, 1, 31)
+        subscription.save()
+        ((subscription, outcome),) = Subscription.objects.ensure_many(
+            [{"user": users[0], "code": "plan", **plan, "periodicity": "yearly"}]
+        )
+        self.assertEqual(outcome, "changed")
+        subscription.refresh_from_db()
+        self.assertEqual(subscription.starts_on, date(2040, 2, 1))
+        self.assertEqual(subscription.periodicity, "yearly")
+
+        # Savepoint, load existing subscriptions, release savepoint
+        with self.assertNumQueries(3):
+            Subscription.objects.ensure_many(
+                [{"user": user, "code": "plan"} for user in users]
+            )
+
+        with self.assertRaises(ValueError):
+            Subscription.objects.ensure_many(
+                [{"user": users[0], "code": "plan"}, {"user": users[0], "code": "plan"}]
+            )
+
     def test_ensure_with_change(self):
         subscription = Subscription.objects.ensure(
             user=self.user,
@@ -481,6 +779,63 @@ class Test(TestCase):
         subscription.refresh_from_db()
         self.assertEqual(subscription.paid_until, date(2018, 1, 31))
 
+    def test_update_paid_until_set_based(self):
+        subscriptions = [
+            Subscription.objects.create(
+                user=self.user,
+                code=f"test{i}",
+                title=f"Test subscription {i}",
+                periodicity="monthly",
+                amount=60,
+                starts_on=date(2018, 1, 1),
+            )
+            for i in range(3)
+        ]
+        for subscription in subscriptions:
+            subscription.create_periods(until=date(2018, 2, 1))
+        SubscriptionPeriod.objects.create_line_items(until=date(2018, 2, 1))
+        payment = Payment.objects.create_pending(user=self.user)
+
+        payment.charged_at = timezone.now()
+        # One grouped query for the latest paid periods, one query for the
+        # subscriptions and one bulk update
+        with self.assertNumQueries(4):
+            payment.save()
+
+        self.assertEqual(
+            set(Subscription.objects.values_list("paid_until", flat=True)),
+            {date(2018, 2, 28)},
+        )
+        self.assertEqual(Subscription.objects.update_paid_until(), 0)
+
+    def test_defer_paid_until_updates(self):
+        subscription = Subscription.objects.create(
+            user=self.user,
+            code="test1",
+            title="Test subscription 1",
+            periodicity="monthly",
+            amount=60,
+            starts_on=date(2018, 1, 1),
+        )
+        for period in subscription.create_periods(until=date(2018, 2, 1)):
+            period.create_line_item()
+            Payment.objects.create_pending(user=self.user)
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with defer_paid_until_updates():
+                with defer_paid_until_updates():
+                    for payment in Payment.objects.all():
+                        payment.charged_at = timezone.now()
+                        payment.save()
+
+                subscription.refresh_from_db()
+                self.assertEqual(subscription.paid_until, date(2017, 12, 31))
+
+        self.assertEqual(len(callbacks), 1)
+        subscription.refresh_from_db()
+        self.assertEqual(subscription.paid_until, date(2018, 2, 28))
+        self.assertEqual(subscription.grace_period_ends_at.date(), date(2018, 3, 8))
+
     def test_admin_create_manual_periodicity(self):
         client = self.login()
         response = client.post(
@@ -522,6 +877,131 @@ class Test(TestCase):
         self.assertEqual(subscription.periods.count(), 0)
         self.assertEqual(len(subscription.create_periods(until=date(2018, 4, 1))), 0)
 
+    def test_disable_autorenewal_bulk(self):
+        for i in range(5):
+            subscription = Subscription.objects.create(
+                user=self.user,
+                code=f"test{i}",
+                title=f"Test subscription {i}",
+                periodicity="monthly",
+                amount=60,
+                starts_on=date(2018, 1, 1),
+            )
+            subscription.create_periods(until=date(2018, 2, 1))
+        SubscriptionPeriod.objects.create_line_items(until=date(2018, 2, 1))
+        Payment.objects.create_pending(user=self.user)
+        # Not past due
+        Subscription.objects.create(
+            user=self.user, code="new", title="New", periodicity="monthly", amount=60
+        )
+
+        reports = []
+        self.assertEqual(
+            Subscription.objects.disable_autorenewal(
+                bulk=True,
+                batch_size=2,
+                max_batches=2,
+                progress=lambda stats: reports.append(vars(stats).copy()),
+            ),
+            4,
+        )
+        self.assertEqual(
+            reports,
+            [{"batches": 1, "subscriptions": 2}, {"batches": 2, "subscriptions": 4}],
+        )
+        self.assertEqual(
+            Subscription.objects.filter(renew_automatically=True).count(), 2
+        )
+
+        # Resume
+        self.assertEqual(Subscription.objects.disable_autorenewal(bulk=True), 1)
+        self.assertEqual(Subscription.objects.disable_autorenewal(bulk=True), 0)
+
+        self.assertEqual(
+            list(
+                Subscription.objects.filter(renew_automatically=False)
+                .values_list("ends_on", flat=True)
+                .distinct()
+            ),
+            [date(2017, 12, 31)],
+        )
+        self.assertEqual(SubscriptionPeriod.objects.count(), 0)
+        self.assertEqual(LineItem.objects.count(), 0)
+        self.assertEqual(Payment.objects.count(), 0)
+        self.assertEqual(Subscription.objects.get(code="new").renew_automatically, True)
+
+    def test_delete_pending_periods_queryset_only(self):
+        # Would delete the pending periods of all subscriptions
+        self.assertFalse(hasattr(Subscription.objects, "delete_pending_periods"))
+        self.assertEqual(Subscription.objects.all().delete_pending_periods(), 0)
+
+    def test_cancel_query_count(self):
+        counts = []
+        for i, until in enumerate([date(2018, 3, 1), date(2018, 12, 1)]):
+            subscription = Subscription.objects.create(
+                user=self.user,
+                code=f"test{i}",
+                title=f"Test subscription {i}",
+                periodicity="monthly",
+                amount=60,
+                starts_on=date(2018, 1, 1),
+            )
+            periods = subscription.create_periods(until=until)
+            self.pay_period(periods[0])
+            for period in periods[1:]:
+                period.create_line_item()
+                Payment.objects.create_pending(
+                    user=self.user, lineitems=[period.line_item]
+                )
+
+            with CaptureQueriesContext(connection) as queries:
+                subscription.cancel()
+            counts.append(len(queries))
+
+            self.assertEqual(subscription.periods.get(), periods[0])
+            self.assertEqual(Payment.objects.pending().count(), 0)
+            subscription.refresh_from_db()
+            self.assertEqual(subscription.paid_until, date(2018, 1, 31))
+
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(LineItem.objects.count(), 2)
+
+    def test_query_plans(self):
+        if connection.vendor not in {"postgresql", "sqlite"}:
+            self.skipTest("Query plans are only checked on PostgreSQL and SQLite")
+        if connection.vendor == "postgresql":
+            # Tables are tiny, sequential scans would always win.
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL enable_seqscan = off")
+
+        for queryset, index in [
+            (Payment.objects.pending(), "user_payments_pending_idx"),
+            (
+                Payment.objects.pending().filter(user=self.user),
+                "user_payments_pending_idx",
+            ),
+            (
+                Subscription.objects.filter(
+                    renew_automatically=True, paid_until__lt=date.today()
+                ),
+                "user_subscr_renewing_idx",
+            ),
+            # Served by the foreign key indexes, which include NULL values
+            (LineItem.objects.unbound().filter(user=self.user), None),
+            (
+                SubscriptionPeriod.objects.filter(
+                    line_item__isnull=True, starts_on__lte=date.today()
+                ),
+                None,
+            ),
+        ]:
+            with self.subTest(query=str(queryset.query)):
+                plan = queryset.explain()
+                if index:
+                    self.assertIn(index, plan)
+                self.assertNotIn("Seq Scan", plan)
+                self.assertNotRegex(plan, r"(?m)SCAN \w+$")
+
     def test_banktransfer_failed(self):
         subscription = Subscription.objects.ensure(
             user=self.user,
@@ -565,7 +1045,77 @@ class Test(TestCase):
         self.assertEqual(payment.amount, 780)
         payment.cancel_pending()
 
-        SubscriptionPeriod.objects.zeroize_pending_periods(lasting_until=today)
+        self.assertEqual(
+            SubscriptionPeriod.objects.zeroize_pending_periods(lasting_until=today), 12
+        )
+        self.assertEqual(
+            SubscriptionPeriod.objects.zeroize_pending_periods(lasting_until=today), 0
+        )
 
         payment = Payment.objects.create_pending(user=self.user)
         self.assertEqual(payment.amount, 60)
+
+    def test_zeroize_pending_periods_chunked(self):
+        subscription = Subscription.objects.create(
+            user=self.user,
+            code="test1",
+            title="Test subscription 1",
+            periodicity="monthly",
+            amount=60,
+            starts_on=date(2018, 1, 1),
+        )
+        periods = subscription.create_periods(until=date(2018, 12, 1))
+        self.pay_period(periods[0])
+        SubscriptionPeriod.objects.create_line_items(until=date(2018, 12, 1))
+        # Other line items are not touched
+        LineItem.objects.create(user=self.user, amount=5, title="Other")
+
+        with self.assertNumQueries(1 + 5):
+            self.assertEqual(
+                SubscriptionPeriod.objects.zeroize_pending_periods(
+                    lasting_until=date(2018, 10, 1), chunk_size=3
+                ),
+                8,
+            )
+        self.assertEqual(
+            sorted(LineItem.objects.values_list("amount", flat=True)),
+            [0] * 8 + [5] + [60] * 4,
+        )
+
+    def test_balances_after_repricing_and_zeroizing(self):
+        s = apps.get_app_config("user_payments").settings
+        subscription = Subscription.objects.create(
+            user=self.user,
+            code="test1",
+            title="Test subscription 1",
+            periodicity="monthly",
+            amount=60,
+            starts_on=date(2018, 1, 1),
+        )
+        subscription.create_periods(until=date(2018, 6, 1))
+
+        with mock.patch.object(s, "maintain_balances", True):
+            with self.captureOnCommitCallbacks(execute=True):
+                SubscriptionPeriod.objects.create_line_items(until=date(2018, 6, 1))
+            balance = Balance.objects.get(user=self.user)
+            self.assertEqual(balance.open_amount, 360)
+
+            with self.captureOnCommitCallbacks(execute=True):
+                subscription.amount = 100
+                subscription.save()
+            balance.refresh_from_db()
+            self.assertEqual(balance.open_amount, 600)
+
+            with self.captureOnCommitCallbacks(execute=True):
+                SubscriptionPeriod.objects.zeroize_pending_periods(
+                    lasting_until=date(2018, 3, 1), chunk_size=2
+                )
+            balance.refresh_from_db()
+            self.assertEqual(balance.open_amount, 400)
+
+            with self.captureOnCommitCallbacks(execute=True):
+                SubscriptionPeriod.objects.zeroize_pending_periods(
+                    lasting_until=date(2018, 7, 1)
+                )
+            balance.refresh_from_db()
+            self.assertEqual(balance.open_amount, 0)
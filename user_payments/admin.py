@@ -34,6 +34,31 @@ class PaymentAdmin(admin.ModelAdmin):
 @admin.register(models.LineItem)
 class LineItemAdmin(admin.ModelAdmin):
     date_hierarchy = "created_at"
-    list_display = ("user", "payment", "created_at", "title", "amount")
+    list_display = (
+        "user",
+        "payment",
+        "created_at",
+        "title",
+        "quantity",
+        "unit_amount",
+        "amount",
+    )
     raw_id_fields = ("user", "payment")
-    search_fields = ("title", f"user__{get_user_model().USERNAME_FIELD}")
+    search_fields = ("title", "key", f"user__{get_user_model().USERNAME_FIELD}")
+
+
+@admin.register(models.Balance)
+class BalanceAdmin(admin.ModelAdmin):
+    list_display = (
+        "user",
+        "open_amount",
+        "pending_amount",
+        "paid_amount",
+        "last_charged_at",
+        "updated_at",
+    )
+    readonly_fields = list_display
+    search_fields = (f"user__{get_user_model().USERNAME_FIELD}",)
+
+    def has_add_permission(self, request):
+        return False
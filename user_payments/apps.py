@@ -13,6 +13,11 @@ class UserPayments(AppConfig):
         "currency": "CHF",
         "grace_period": timedelta(days=7),
         "disable_autorenewal_after": timedelta(days=15),
+        "description_max_length": 1000,
+        "maintain_balances": False,
+        "metering_buffer_size": 500,
+        "metering_max_age": timedelta(seconds=5),
+        "metering_aggregate": False,
     }
 
     def ready(self):
@@ -0,0 +1,153 @@
+import bisect
+import threading
+from collections import defaultdict
+
+
+#: Upper bounds of the latency histogram buckets in seconds, the same
+#: defaults Prometheus client libraries use.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf"))
+
+
+class Instrument:
+    """
+    Base class for instruments passed to the processing functions
+
+    All methods are called synchronously, possibly from several threads at
+    once when processing payments with ``workers``. The default
+    implementations do nothing.
+    """
+
+    def processor_called(self, *, payment, processor, result, seconds):
+        """
+        A processor returned ``result`` after ``seconds``
+        """
+
+    def payment_processed(self, *, payment, success, seconds):
+        """
+        All processors for the payment have run. ``success`` is ``False``
+        if a processor raised an exception.
+        """
+
+    def batch_processed(self, *, name, stats, seconds):
+        """
+        A batch function such as ``process_unbound_items`` has finished
+        """
+
+
+class Instruments(Instrument):
+    """
+    Forward all calls to several instruments
+    """
+
+    def __init__(self, *instruments):
+        self.instruments = [i for i in instruments if i is not None]
+
+    def processor_called(self, **kwargs):
+        for instrument in self.instruments:
+            instrument.processor_called(**kwargs)
+
+    def payment_processed(self, **kwargs):
+        for instrument in self.instruments:
+            instrument.payment_processed(**kwargs)
+
+    def batch_processed(self, **kwargs):
+        for instrument in self.instruments:
+            instrument.batch_processed(**kwargs)
+
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """
+        Return ``(upper bound, count)`` tuples as used by Prometheus
+        """
+        total, result = 0, []
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Summary(Instrument):
+    """
+    Aggregates counts and latencies. The batch functions attach a summary to
+    the statistics they return as ``stats.summary``.
+
+    - ``results[processor][result]``: Number of calls per processor name and
+      ``Result`` name.
+    - ``processor_latency[processor]``: Latency ``Histogram`` per processor.
+    - ``payments``, ``succeeded`` and ``payment_latency``: Payments processed.
+    - ``batches``: ``(name, seconds)`` tuples of finished batch functions.
+    """
+
+    def __init__(self):
+        self.results = defaultdict(lambda: defaultdict(int))
+        self.processor_latency = defaultdict(Histogram)
+        self.payments = 0
+        self.succeeded = 0
+        self.payment_latency = Histogram()
+        self.batches = []
+        self._lock = threading.Lock()
+
+    def processor_called(self, *, payment, processor, result, seconds):
+        with self._lock:
+            self.results[processor.__name__][result.name] += 1
+            self.processor_latency[processor.__name__].observe(seconds)
+
+    def payment_processed(self, *, payment, success, seconds):
+        with self._lock:
+            self.payments += 1
+            if success:
+                self.succeeded += 1
+            self.payment_latency.observe(seconds)
+
+    def batch_processed(self, *, name, stats, seconds):
+        with self._lock:
+            self.batches.append((name, seconds))
+
+
+def export_statsd(summary, send, *, prefix="user_payments"):
+    """
+    Send the contents of a ``Summary`` as statsd counters. ``send`` is
+    called with each line as a string, e.g. ``"user_payments.payments:3|c"``.
+
+    Histograms are sent as one counter per non-empty bucket named after its
+    upper bound in milliseconds (``latency.le_50ms``, ``latency.le_inf``)
+    plus ``latency.count`` and ``latency.sum_ms``.
+    """
+    send(f"{prefix}.payments:{summary.payments}|c")
+    send(f"{prefix}.payments.succeeded:{summary.succeeded}|c")
+    for processor, results in sorted(summary.results.items()):
+        for result, count in sorted(results.items()):
+            send(f"{prefix}.processor.{processor}.{result.lower()}:{count}|c")
+
+    histograms = [("payment", summary.payment_latency)] + [
+        (f"processor.{processor}", histogram)
+        for processor, histogram in sorted(summary.processor_latency.items())
+    ]
+    for name, histogram in histograms:
+        if not histogram.count:
+            continue
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            if count:
+                le = "inf" if bound == float("inf") else f"{bound * 1000:g}ms"
+                send(f"{prefix}.{name}.latency.le_{le}:{count}|c")
+        send(f"{prefix}.{name}.latency.count:{histogram.count}|c")
+        send(f"{prefix}.{name}.latency.sum_ms:{histogram.sum * 1000:.0f}|c")
+
+    for name, seconds in summary.batches:
+        send(f"{prefix}.batch.{name}:{seconds * 1000:.0f}|ms")
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from user_payments.models import Balance
+
+
+class Command(BaseCommand):
+    help = "Recompute the balances of all users from line items and payments"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=500,
+            help="Number of users refreshed at once",
+        )
+
+    def handle(self, **options):
+        count = Balance.objects.refresh(chunk_size=options["chunk_size"])
+        self.stdout.write(f"Refreshed the balances of {count} users.")
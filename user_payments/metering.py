@@ -0,0 +1,157 @@
+import atexit
+import itertools
+import threading
+import time
+from decimal import Decimal
+
+from django.apps import apps
+from django.core.signals import request_finished
+from django.db import connection, transaction
+from django.utils import timezone
+
+from user_payments.models import LineItem, balances_changed
+
+
+class LineItemBuffer:
+    """
+    Collects line items in memory and inserts them using ``bulk_create``
+    once ``max_size`` rows are waiting or the oldest row has been waiting
+    for ``max_age`` seconds. Thresholds are checked when adding line items
+    and when calling ``flush(force=False)``.
+
+    With ``aggregate=True`` identical ``(user, title, amount)`` entries are
+    merged into one row with a ``quantity``. The buffer is shared between
+    all threads of the process.
+    """
+
+    def __init__(self, *, max_size=500, max_age=5, aggregate=False):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.aggregate = aggregate
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+        self._entries = {}
+        self._started = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, *, user, title, amount):
+        """
+        Add a line item for ``user`` (a user or a primary key). Flushes the
+        buffer if a threshold has been reached. Inside a transaction the
+        flush is deferred until the transaction has been committed, so that
+        a rollback does not discard line items added by other threads.
+        """
+        amount = Decimal(amount).quantize(Decimal("0.01"))
+        user_id = getattr(user, "pk", user)
+        key = (
+            (user_id, title, amount)
+            if self.aggregate
+            else (user_id, title, amount, next(self._counter))
+        )
+        with self._lock:
+            if not self._entries:
+                self._started = time.monotonic()
+            if key in self._entries:
+                self._entries[key][1] += 1
+            else:
+                self._entries[key] = [timezone.now(), 1]
+            due = self._due()
+        if due:
+            if connection.in_atomic_block:
+                # Entries stay buffered if the transaction is rolled back.
+                transaction.on_commit(lambda: self.flush(force=False))
+            else:
+                self.flush()
+
+    def _due(self):
+        return bool(self._entries) and (
+            len(self._entries) >= self.max_size
+            or time.monotonic() - self._started >= self.max_age
+        )
+
+    def flush(self, *, force=True):
+        """
+        Insert all buffered line items, or only if a threshold has been
+        reached if ``force`` is ``False``. Entries are kept in the buffer
+        if inserting fails. Line items are inserted using the current
+        thread's connection, do not call this inside a transaction which
+        may be rolled back.
+
+        Returns the number of line items inserted.
+        """
+        with self._lock:
+            if not (self._entries if force else self._due()):
+                return 0
+            entries, self._entries = self._entries, {}
+
+        line_items = [
+            LineItem(
+                user_id=key[0],
+                title=key[1],
+                quantity=count,
+                unit_amount=key[2],
+                amount=key[2] * count,
+                created_at=created_at,
+            )
+            for key, (created_at, count) in entries.items()
+        ]
+        try:
+            LineItem.objects.bulk_create(line_items)
+        except Exception:
+            with self._lock:
+                for key, (created_at, count) in entries.items():
+                    if key in self._entries:
+                        self._entries[key][0] = created_at
+                        self._entries[key][1] += count
+                    else:
+                        self._entries[key] = [created_at, count]
+                self._started = time.monotonic()
+            raise
+
+        balances_changed({item.user_id for item in line_items})
+        return len(line_items)
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_buffer():
+    """
+    Return the process-wide buffer configured by the ``metering_*``
+    settings. The buffer is flushed when thresholds are reached, after
+    requests if a threshold has been reached meanwhile and at interpreter
+    shutdown.
+    """
+    global _buffer
+    with _buffer_lock:
+        if _buffer is None:
+            s = apps.get_app_config("user_payments").settings
+            _buffer = LineItemBuffer(
+                max_size=s.metering_buffer_size,
+                max_age=s.metering_max_age.total_seconds(),
+                aggregate=s.metering_aggregate,
+            )
+            request_finished.connect(_request_finished)
+            atexit.register(flush)
+        return _buffer
+
+
+def meter(*, user, title, amount):
+    """
+    Bill ``amount`` to ``user`` without writing to the database right away
+    """
+    get_buffer().add(user=user, title=title, amount=amount)
+
+
+def flush():
+    """
+    Insert all line items buffered by ``meter()``
+    """
+    return _buffer.flush() if _buffer is not None else 0
+
+
+def _request_finished(sender, **kwargs):
+    _buffer.flush(force=False)
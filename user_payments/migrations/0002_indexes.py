@@ -0,0 +1,38 @@
+from django.db import migrations, models
+
+
+FALLBACK_INDEX = models.Index(
+    fields=["charged_at", "user"], name="user_payments_pending_fb"
+)
+
+
+def add_fallback_index(apps, schema_editor):
+    # Databases without partial indexes (e.g. MySQL) silently skip the
+    # conditional index below, add a composite index instead.
+    if not schema_editor.connection.features.supports_partial_indexes:
+        schema_editor.add_index(
+            apps.get_model("user_payments", "Payment"), FALLBACK_INDEX
+        )
+
+
+def remove_fallback_index(apps, schema_editor):
+    if not schema_editor.connection.features.supports_partial_indexes:
+        schema_editor.remove_index(
+            apps.get_model("user_payments", "Payment"), FALLBACK_INDEX
+        )
+
+
+class Migration(migrations.Migration):
+    dependencies = [("user_payments", "0001_initial")]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="payment",
+            index=models.Index(
+                condition=models.Q(charged_at__isnull=True),
+                fields=["user"],
+                name="user_payments_pending_idx",
+            ),
+        ),
+        migrations.RunPython(add_fallback_index, remove_fallback_index),
+    ]
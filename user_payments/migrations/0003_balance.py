@@ -0,0 +1,75 @@
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("user_payments", "0002_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Balance",
+            fields=[
+                (
+                    "user",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="user_payments_balance",
+                        serialize=False,
+                        to=settings.AUTH_USER_MODEL,
+                        verbose_name="user",
+                    ),
+                ),
+                (
+                    "open_amount",
+                    models.DecimalField(
+                        decimal_places=2,
+                        default=0,
+                        help_text="Line items not bound to a payment yet.",
+                        max_digits=12,
+                        verbose_name="open amount",
+                    ),
+                ),
+                (
+                    "pending_amount",
+                    models.DecimalField(
+                        decimal_places=2,
+                        default=0,
+                        max_digits=12,
+                        verbose_name="pending amount",
+                    ),
+                ),
+                (
+                    "paid_amount",
+                    models.DecimalField(
+                        decimal_places=2,
+                        default=0,
+                        help_text="Lifetime total of charged payments.",
+                        max_digits=12,
+                        verbose_name="paid amount",
+                    ),
+                ),
+                (
+                    "last_charged_at",
+                    models.DateTimeField(
+                        blank=True, null=True, verbose_name="last charged at"
+                    ),
+                ),
+                (
+                    "updated_at",
+                    models.DateTimeField(
+                        default=django.utils.timezone.now, verbose_name="updated at"
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "balance",
+                "verbose_name_plural": "balances",
+            },
+        ),
+    ]
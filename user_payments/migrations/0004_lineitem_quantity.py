@@ -0,0 +1,63 @@
+from django.db import migrations, models
+from django.db.models import F
+
+
+def set_unit_amount(apps, schema_editor):
+    apps.get_model("user_payments", "LineItem").objects.update(unit_amount=F("amount"))
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("user_payments", "0003_balance"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="lineitem",
+            name="key",
+            field=models.CharField(
+                blank=True,
+                help_text="Identifies the line item for LineItem.objects.increment().",
+                max_length=100,
+                verbose_name="key",
+            ),
+        ),
+        migrations.AddField(
+            model_name="lineitem",
+            name="quantity",
+            field=models.PositiveIntegerField(default=1, verbose_name="quantity"),
+        ),
+        migrations.AddField(
+            model_name="lineitem",
+            name="unit_amount",
+            field=models.DecimalField(
+                blank=True,
+                decimal_places=2,
+                help_text="Defaults to the amount divided by the quantity.",
+                max_digits=10,
+                null=True,
+                verbose_name="unit amount",
+            ),
+        ),
+        migrations.RunPython(set_unit_amount, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="lineitem",
+            name="amount",
+            field=models.DecimalField(
+                decimal_places=2,
+                help_text="Quantity times unit amount.",
+                max_digits=10,
+                verbose_name="amount",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="lineitem",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(
+                    ("payment__isnull", True), models.Q(("key", ""), _negated=True)
+                ),
+                fields=("user", "key"),
+                name="user_payments_lineitem_open_key",
+            ),
+        ),
+    ]
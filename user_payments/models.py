@@ -1,7 +1,22 @@
+from decimal import Decimal
+from threading import local
+
+from django.apps import apps
 from django.conf import settings
-from django.db import models, transaction
-from django.db.models import Q
+from django.db import IntegrityError, models, transaction
+from django.db.models import (
+    ExpressionWrapper,
+    F,
+    Max,
+    OuterRef,
+    Q,
+    Subquery,
+    Sum,
+    signals,
+)
+from django.db.models.functions import Coalesce
 from django.utils import timezone
+from django.utils.text import Truncator
 from django.utils.translation import gettext, gettext_lazy as _
 from mooch.models import Payment as AbstractPayment
 
@@ -10,6 +25,13 @@ class PaymentQuerySet(models.QuerySet):
     def pending(self):
         return self.filter(charged_at__isnull=True)
 
+    def with_description(self):
+        """
+        Prefetch line items so that ``payment.description`` does not need
+        an additional query per payment.
+        """
+        return self.prefetch_related("lineitems")
+
 
 class PaymentManager(models.Manager):
     def create_pending(self, *, user, lineitems=None, **kwargs):
@@ -32,6 +54,64 @@ class PaymentManager(models.Manager):
             items.update(payment=payment)
             return payment
 
+    def create_pending_bulk(self, *, users=None, chunk_size=500):
+        """
+        Create unpaid payment instances for all users with unbound line items
+        using a few set-based statements per chunk of users instead of calling
+        ``create_pending`` once per user.
+
+        This generator yields lists of payments, one list per chunk. Each
+        chunk is committed before it is yielded. Line items created after the
+        generator has been started are left alone.
+
+        Users are loaded from the ``users`` queryset if given, e.g. to
+        ``select_related`` data needed by processors.
+        """
+        latest = LineItem.objects.aggregate(m=Max("id"))["m"]
+        if latest is None:
+            return
+
+        if users is None:
+            users = self.model._meta.get_field("user").related_model._default_manager
+        last_user = None
+        while True:
+            with transaction.atomic():
+                items = LineItem.objects.unbound().filter(id__lte=latest)
+                if last_user is not None:
+                    items = items.filter(user__gt=last_user)
+                rows = list(
+                    items.values("user")
+                    .annotate(amount=Sum("amount"))
+                    .order_by("user")[:chunk_size]
+                )
+                if not rows:
+                    return
+
+                chunk_users = users.in_bulk([row["user"] for row in rows])
+                payments = self.bulk_create(
+                    [
+                        self.model(
+                            user=chunk_users[row["user"]],
+                            amount=row["amount"].quantize(Decimal("0.01")),
+                            email=chunk_users[row["user"]].email,
+                        )
+                        for row in rows
+                        if row["user"] in chunk_users
+                    ]
+                )
+                items.filter(user__in=list(chunk_users)).update(
+                    payment=Subquery(
+                        self.filter(
+                            pk__in=[payment.pk for payment in payments],
+                            user=OuterRef("user"),
+                        ).values("pk")[:1]
+                    )
+                )
+                balances_changed(chunk_users)
+
+            yield payments
+            last_user = rows[-1]["user"]
+
 
 class Payment(AbstractPayment):
     user = models.ForeignKey(
@@ -43,6 +123,16 @@ class Payment(AbstractPayment):
 
     objects = PaymentManager.from_queryset(PaymentQuerySet)()
 
+    class Meta(AbstractPayment.Meta):
+        indexes = [
+            # Payment.objects.pending()
+            models.Index(
+                fields=["user"],
+                condition=Q(charged_at__isnull=True),
+                name="user_payments_pending_idx",
+            )
+        ]
+
     def __str__(self):
         if self.charged_at:
             return gettext("Payment of %s") % self.amount
@@ -68,16 +158,25 @@ class Payment(AbstractPayment):
         self.save()
         # Unbind line items after post_save signal handling
         self.lineitems.update(payment=None)
+        balances_changed([self.user_id])
 
     undo.alters_data = True
 
     @property
     def description(self):
-        return "Payment of {} by {}: {}".format(
-            self.amount,
-            self.email,
-            ", ".join(str(item) for item in self.lineitems.all()),
-        )
+        """
+        Uses prefetched line items if available (see
+        ``Payment.objects.with_description()``). Descriptions are truncated
+        to ``USER_PAYMENTS['description_max_length']`` characters.
+        """
+        s = apps.get_app_config("user_payments").settings
+        return Truncator(
+            "Payment of {} by {}: {}".format(
+                self.amount,
+                self.email,
+                ", ".join(str(item) for item in self.lineitems.all()),
+            )
+        ).chars(s.description_max_length)
 
 
 class LineItemQuerySet(models.QuerySet):
@@ -90,6 +189,46 @@ class LineItemQuerySet(models.QuerySet):
         )
 
 
+class LineItemManager(models.Manager):
+    def increment(self, user, key, quantity=1, *, title, unit_amount):
+        """
+        Add ``quantity`` to the unbound line item of ``user`` (a user or a
+        primary key) for ``key`` using an ``F()`` expression, or create the
+        line item with ``title`` and ``unit_amount`` if there is none yet.
+        Concurrent increments do not lose updates, and the unique constraint
+        on ``(user, key)`` of unbound line items prevents duplicates.
+
+        Returns ``True`` if a line item has been created.
+        """
+        user_id = getattr(user, "pk", user)
+        items = self.filter(user=user_id, key=key, payment__isnull=True)
+        increment = {
+            "quantity": F("quantity") + quantity,
+            "amount": ExpressionWrapper(
+                (F("quantity") + quantity) * F("unit_amount"),
+                output_field=models.DecimalField(max_digits=10, decimal_places=2),
+            ),
+        }
+        created = False
+        with transaction.atomic():
+            if not items.update(**increment):
+                try:
+                    with transaction.atomic():
+                        self.create(
+                            user_id=user_id,
+                            key=key,
+                            title=title,
+                            quantity=quantity,
+                            unit_amount=unit_amount,
+                        )
+                    created = True
+                except IntegrityError:
+                    # Created concurrently.
+                    items.update(**increment)
+        balances_changed([user_id])
+        return created
+
+
 class LineItem(models.Model):
     """
     Individual line items may be created directly using the manager method. A
@@ -106,6 +245,11 @@ class LineItem(models.Model):
             # Rest of view
 
     If you already have a payment instance at hand you may pass it as well.
+    Instead of ``amount`` you may also pass ``unit_amount`` and
+    ``quantity``, the amount is then computed when saving.
+
+    ``user_payments.metering.meter()`` buffers line items and inserts them
+    in batches instead, which is preferable for frequently billed views.
     """
 
     user = models.ForeignKey(
@@ -116,7 +260,27 @@ class LineItem(models.Model):
     )
     created_at = models.DateTimeField(_("created at"), default=timezone.now)
     title = models.CharField(_("title"), max_length=200)
-    amount = models.DecimalField(_("amount"), max_digits=10, decimal_places=2)
+    quantity = models.PositiveIntegerField(_("quantity"), default=1)
+    unit_amount = models.DecimalField(
+        _("unit amount"),
+        max_digits=10,
+        decimal_places=2,
+        blank=True,
+        null=True,
+        help_text=_("Defaults to the amount divided by the quantity."),
+    )
+    amount = models.DecimalField(
+        _("amount"),
+        max_digits=10,
+        decimal_places=2,
+        help_text=_("Quantity times unit amount."),
+    )
+    key = models.CharField(
+        _("key"),
+        max_length=100,
+        blank=True,
+        help_text=_("Identifies the line item for LineItem.objects.increment()."),
+    )
 
     payment = models.ForeignKey(
         Payment,
@@ -127,12 +291,230 @@ class LineItem(models.Model):
         verbose_name=_("payment"),
     )
 
-    objects = LineItemQuerySet.as_manager()
+    objects = LineItemManager.from_queryset(LineItemQuerySet)()
 
     class Meta:
+        constraints = [
+            # LineItem.objects.increment()
+            models.UniqueConstraint(
+                fields=["user", "key"],
+                condition=Q(payment__isnull=True) & ~Q(key=""),
+                name="user_payments_lineitem_open_key",
+            )
+        ]
         ordering = ["-created_at"]
         verbose_name = _("line item")
         verbose_name_plural = _("line items")
 
     def __str__(self):
-        return self.title
+        if self.quantity == 1:
+            return self.title
+        return f"{self.title} ({self.quantity}×)"
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_pricing = instance._pricing()
+        return instance
+
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        self._loaded_pricing = self._pricing()
+
+    def _pricing(self):
+        return tuple(
+            self.__dict__.get(field) for field in ("quantity", "unit_amount", "amount")
+        )
+
+    def save(self, *args, **kwargs):
+        loaded = getattr(self, "_loaded_pricing", None)
+        current = self._pricing()
+        if self.unit_amount is None or (
+            loaded is not None and loaded[:2] == current[:2] and loaded[2] != current[2]
+        ):
+            # Line items created by passing the amount only, or only the
+            # amount has been changed since loading.
+            self.unit_amount = (Decimal(self.amount) / self.quantity).quantize(
+                Decimal("0.01")
+            )
+        elif loaded is None or loaded[:2] != current[:2]:
+            self.amount = self.quantity * self.unit_amount
+        # Otherwise leave the amount alone, it may have been set using
+        # update() without touching the unit amount.
+        super().save(*args, **kwargs)
+        self._loaded_pricing = self._pricing()
+
+    save.alters_data = True
+
+
+class BalanceManager(models.Manager):
+    def refresh(self, users=None, *, chunk_size=500):
+        """
+        Recompute the balances of ``users`` (users or primary keys) from
+        their line items and payments, or the balances of all users if
+        ``users`` is ``None``. Uses a constant number of queries per chunk
+        of users. Rows are only created for users which have line items or
+        payments.
+
+        Returns the number of users refreshed.
+        """
+        if users is not None:
+            pks = sorted({getattr(user, "pk", user) for user in users})
+            for i in range(0, len(pks), chunk_size):
+                self._refresh_chunk(pks[i : i + chunk_size])
+            return len(pks)
+
+        user_model = self.model._meta.get_field("user").related_model
+        count, last = 0, None
+        while True:
+            queryset = user_model._default_manager.order_by("pk")
+            if last is not None:
+                queryset = queryset.filter(pk__gt=last)
+            pks = list(queryset.values_list("pk", flat=True)[:chunk_size])
+            if not pks:
+                return count
+            self._refresh_chunk(pks)
+            count += len(pks)
+            last = pks[-1]
+
+    def _refresh_chunk(self, pks):
+        def totals(queryset, **aggregates):
+            return {
+                row.pop("user"): row
+                for row in queryset.filter(user__in=pks)
+                .order_by()
+                .values("user")
+                .annotate(**aggregates)
+            }
+
+        unbound = totals(LineItem.objects.unbound(), amount=Sum("amount"))
+        pending = totals(Payment.objects.pending(), amount=Sum("amount"))
+        paid = totals(
+            Payment.objects.filter(charged_at__isnull=False),
+            amount=Sum("amount"),
+            last_charged_at=Max("charged_at"),
+        )
+        existing = set(self.filter(user__in=pks).values_list("user", flat=True))
+
+        now = timezone.now()
+        update, create = [], []
+        for pk in pks:
+            balance = self.model(
+                user_id=pk,
+                open_amount=unbound.get(pk, {}).get("amount") or 0,
+                pending_amount=pending.get(pk, {}).get("amount") or 0,
+                paid_amount=paid.get(pk, {}).get("amount") or 0,
+                last_charged_at=paid.get(pk, {}).get("last_charged_at"),
+                updated_at=now,
+            )
+            if pk in existing:
+                update.append(balance)
+            elif pk in unbound or pk in pending or pk in paid:
+                create.append(balance)
+
+        with transaction.atomic():
+            self.bulk_update(
+                update,
+                [
+                    "open_amount",
+                    "pending_amount",
+                    "paid_amount",
+                    "last_charged_at",
+                    "updated_at",
+                ],
+            )
+            self.bulk_create(create)
+
+    def annotate_users(self, users):
+        """
+        Annotate the ``users`` queryset with ``open_amount``,
+        ``pending_amount``, ``paid_amount`` and ``last_charged_at`` from the
+        balance table using a single join, e.g. for dashboards. Users
+        without a balance get zero amounts.
+        """
+        zero = models.Value(Decimal("0.00"), output_field=models.DecimalField())
+        return users.annotate(
+            **{
+                field: Coalesce(F(f"user_payments_balance__{field}"), zero)
+                for field in ("open_amount", "pending_amount", "paid_amount")
+            },
+            last_charged_at=F("user_payments_balance__last_charged_at"),
+        )
+
+
+class Balance(models.Model):
+    """
+    Denormalized totals per user, see ``Balance.objects.refresh()`` and the
+    ``maintain_balances`` setting
+    """
+
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="user_payments_balance",
+        verbose_name=_("user"),
+    )
+    open_amount = models.DecimalField(
+        _("open amount"),
+        max_digits=12,
+        decimal_places=2,
+        default=0,
+        help_text=_("Line items not bound to a payment yet."),
+    )
+    pending_amount = models.DecimalField(
+        _("pending amount"), max_digits=12, decimal_places=2, default=0
+    )
+    paid_amount = models.DecimalField(
+        _("paid amount"),
+        max_digits=12,
+        decimal_places=2,
+        default=0,
+        help_text=_("Lifetime total of charged payments."),
+    )
+    last_charged_at = models.DateTimeField(_("last charged at"), blank=True, null=True)
+    updated_at = models.DateTimeField(_("updated at"), default=timezone.now)
+
+    objects = BalanceManager()
+
+    class Meta:
+        verbose_name = _("balance")
+        verbose_name_plural = _("balances")
+
+    def __str__(self):
+        return gettext("Balance of %s") % self.user
+
+
+_balances = local()
+
+
+def _flush_balances():
+    users, _balances.users = getattr(_balances, "users", None), set()
+    if users:
+        Balance.objects.refresh(users)
+
+
+def balances_changed(users):
+    """
+    Schedule a refresh of the balances of ``users`` (primary keys) once the
+    current transaction commits. Does nothing unless the
+    ``maintain_balances`` setting is enabled. Call this after modifying line
+    items or payments without sending signals, e.g. using ``update()``.
+    """
+    if not apps.get_app_config("user_payments").settings.maintain_balances:
+        return
+    if getattr(_balances, "users", None) is None:
+        _balances.users = set()
+    _balances.users.update(users)
+    # All callbacks but the first find an empty set; the set survives
+    # rollbacks, refreshing too many balances is harmless.
+    transaction.on_commit(_flush_balances)
+
+
+def _instance_changed(sender, instance, **kwargs):
+    balances_changed([instance.user_id])
+
+
+for _sender in (Payment, LineItem):
+    signals.post_save.connect(_instance_changed, sender=_sender)
+    signals.post_delete.connect(_instance_changed, sender=_sender)
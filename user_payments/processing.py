@@ -1,8 +1,20 @@
+import asyncio
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from enum import Enum
+from queue import Queue
+from types import SimpleNamespace
 
+from asgiref.sync import sync_to_async
+from django.apps import apps
 from django.contrib.auth import get_user_model
+from django.db import connection, connections, transaction
+from django.db.models import prefetch_related_objects
 
+from user_payments.instrumentation import Instruments, Summary
 from user_payments.models import LineItem, Payment
 
 
@@ -26,50 +38,161 @@ class ResultError(Exception):
     pass
 
 
-def process_payment(payment, *, processors, cancel_on_failure=True):
+def _check_result(payment, processor, result):
+    if result == Result.SUCCESS:
+        logger.info(
+            "Success: %(payment)s by %(email)s with %(processor)s",
+            {
+                "payment": payment,
+                "email": payment.email,
+                "processor": processor.__name__,
+            },
+        )
+
+    elif result == Result.TERMINATE:
+        logger.info(
+            "Warning: Processor %(processor)s terminates processing of"
+            " %(payment)s by %(email)s",
+            {
+                "payment": payment,
+                "email": payment.email,
+                "processor": processor.__name__,
+            },
+        )
+
+    elif result == Result.FAILURE:
+        # It's fine, do nothing.
+        pass
+
+    else:
+        raise ResultError(f"Invalid result {result!r} from {processor.__name__}")
+
+    return result
+
+
+def process_payment(payment, *, processors, cancel_on_failure=True, instrument=None):
     logger.info(
         "Processing: %(payment)s by %(email)s",
         {"payment": payment, "email": payment.email},
     )
     success = False
+    start = time.perf_counter()
 
     try:
         for processor in processors:
             # Success processing the payment?
-            result = processor(payment)
-            if result == Result.SUCCESS:
-                logger.info(
-                    "Success: %(payment)s by %(email)s with %(processor)s",
-                    {
-                        "payment": payment,
-                        "email": payment.email,
-                        "processor": processor.__name__,
-                    },
+            called = time.perf_counter()
+            result = _check_result(payment, processor, processor(payment))
+            if instrument is not None:
+                instrument.processor_called(
+                    payment=payment,
+                    processor=processor,
+                    result=result,
+                    seconds=time.perf_counter() - called,
                 )
+            if result == Result.SUCCESS:
                 success = True
                 return True
 
             elif result == Result.TERMINATE:
-                logger.info(
-                    "Warning: Processor %(processor)s terminates processing of"
-                    " %(payment)s by %(email)s",
-                    {
-                        "payment": payment,
-                        "email": payment.email,
-                        "processor": processor.__name__,
-                    },
-                )
                 break
 
-            elif result == Result.FAILURE:
-                # It's fine, do nothing.
-                pass
+        else:
+            logger.warning(
+                "Warning: No success processing %(payment)s by %(email)s",
+                {"payment": payment, "email": payment.email},
+            )
+
+    except Exception:
+        logger.exception("Exception while processing %(payment)s by %(email)s")
+        raise
+
+    finally:
+        if not success and cancel_on_failure:
+            payment.cancel_pending()
+        if instrument is not None:
+            instrument.payment_processed(
+                payment=payment, success=success, seconds=time.perf_counter() - start
+            )
+
+
+def _call_in_thread(processor, payment):
+    try:
+        return processor(payment)
+    finally:
+        # Executor threads open their own database connection.
+        connection.close()
+
+
+def _shutdown_executor(executor, workers):
+    """
+    Close the database connections of all ``workers`` threads of the
+    executor once and shut it down
+    """
+    # Each task blocks until all of them are running, so every thread
+    # (including threads which haven't been started yet) runs exactly one.
+    barrier = threading.Barrier(workers)
+
+    def close():
+        try:
+            barrier.wait(timeout=10)
+        except threading.BrokenBarrierError:  # pragma: no cover
+            pass
+        connections.close_all()
+
+    for _ in range(workers):
+        executor.submit(close)
+    executor.shutdown(wait=True)
+
+
+async def aprocess_payment(
+    payment, *, processors, cancel_on_failure=True, instrument=None, executor=None
+):
+    """
+    Asynchronous variant of ``process_payment``
+
+    Processors may either be coroutine functions or plain synchronous
+    callables. The latter are run in ``executor`` if given. Otherwise they
+    are run in a thread executor and the thread's database connection is
+    closed after each call, which means reconnecting for every call of a
+    synchronous processor which uses the database.
+    """
+    logger.info(
+        "Processing: %(payment)s by %(email)s",
+        {"payment": payment, "email": payment.email},
+    )
+    success = False
+    start = time.perf_counter()
 
+    try:
+        for processor in processors:
+            called = time.perf_counter()
+            if asyncio.iscoroutinefunction(processor):
+                result = await processor(payment)
+            elif executor is not None:
+                result = await asyncio.get_running_loop().run_in_executor(
+                    executor, processor, payment
+                )
             else:
-                raise ResultError(
-                    f"Invalid result {result!r} from {processor.__name__}"
+                result = await sync_to_async(_call_in_thread, thread_sensitive=False)(
+                    processor, payment
                 )
 
+            result = _check_result(payment, processor, result)
+            if instrument is not None:
+                instrument.processor_called(
+                    payment=payment,
+                    processor=processor,
+                    result=result,
+                    seconds=time.perf_counter() - called,
+                )
+            if result == Result.SUCCESS:
+                success = True
+                return True
+
+            elif result == Result.TERMINATE:
+                break
+
         else:
             logger.warning(
                 "Warning: No success processing %(payment)s by %(email)s",
@@ -82,20 +205,365 @@ def process_payment(payment, *, processors, cancel_on_failure=True):
 
     finally:
         if not success and cancel_on_failure:
-            payment.cancel_pending()
+            await sync_to_async(payment.cancel_pending)()
+        if instrument is not None:
+            instrument.payment_processed(
+                payment=payment, success=success, seconds=time.perf_counter() - start
+            )
+
+
+def _has_stripe_customers():
+    return apps.is_installed("user_payments.stripe_customers")
 
 
-def process_unbound_items(*, processors):
-    for user in (
-        get_user_model()
-        .objects.filter(id__in=LineItem.objects.unbound().values("user"))
-        .select_related("stripe_customer")
-    ):
-        payment = Payment.objects.create_pending(user=user)
-        if payment:  # pragma: no branch (very unlikely)
-            process_payment(payment, processors=processors)
+@contextmanager
+def _count_queries():
+    counter = SimpleNamespace(queries=0)
 
+    def wrapper(execute, sql, params, many, context):
+        counter.queries += 1
+        return execute(sql, params, many, context)
 
-def process_pending_payments(*, processors):
-    for payment in Payment.objects.pending():
-        process_payment(payment, cancel_on_failure=False, processors=processors)
+    with connection.execute_wrapper(wrapper):
+        yield counter
+
+
+def _create_pending_serially(users, *, chunk_size):
+    users = users.filter(id__in=LineItem.objects.unbound().values("user"))
+    last_pk = None
+    while True:
+        chunk = users if last_pk is None else users.filter(pk__gt=last_pk)
+        chunk = list(chunk.order_by("pk")[:chunk_size])
+        if not chunk:
+            return
+        for user in chunk:
+            payment = Payment.objects.create_pending(user=user)
+            if payment:  # pragma: no branch (very unlikely)
+                yield [payment]
+        last_pk = chunk[-1].pk
+
+
+def _process(chunks, *, processors, cancel_on_failure, instrument):
+    stats = SimpleNamespace(payments=0, succeeded=0, queries=0)
+    with _count_queries() as counter:
+        for payments in chunks:
+            for payment in payments:
+                stats.payments += 1
+                if process_payment(
+                    payment,
+                    processors=processors,
+                    cancel_on_failure=cancel_on_failure,
+                    instrument=instrument,
+                ):
+                    stats.succeeded += 1
+    stats.queries = counter.queries
+    return stats
+
+
+def _claim_and_process(pk, *, processors, cancel_on_failure, instrument):
+    """
+    Lock the pending payment using ``SELECT ... FOR UPDATE SKIP LOCKED`` and
+    process it while holding the lock. Returns ``None`` if the payment has
+    already been claimed elsewhere or isn't pending anymore.
+    """
+    error = None
+    with transaction.atomic():
+        payment = (
+            _processing_queryset()
+            .select_for_update(
+                skip_locked=True,
+                # Do not lock the nullable side of the stripe_customer join
+                of=("self",) if connection.features.has_select_for_update_of else (),
+            )
+            .filter(pk=pk)
+            .first()
+        )
+        if payment is None:
+            return None
+        try:
+            success = process_payment(
+                payment,
+                processors=processors,
+                cancel_on_failure=cancel_on_failure,
+                instrument=instrument,
+            )
+        except Exception as exc:
+            # Commit the cancellation (if any) before reraising
+            error = exc
+    if error is not None:
+        raise error
+    return bool(success)
+
+
+_DONE = object()
+
+
+def _worker(queue, *, stop, close_connection=False, **kwargs):
+    stats = SimpleNamespace(payments=0, succeeded=0, skipped=0, queries=0)
+    start = time.monotonic()
+    try:
+        with _count_queries() as counter:
+            while not stop.is_set():
+                pk = queue.get()
+                if pk is _DONE:
+                    break
+                try:
+                    result = _claim_and_process(pk, **kwargs)
+                except Exception:
+                    stop.set()
+                    raise
+                if result is None:
+                    stats.skipped += 1
+                    continue
+                stats.payments += 1
+                if result:
+                    stats.succeeded += 1
+        stats.queries = counter.queries
+    finally:
+        if close_connection:
+            # Only threads of the executor, never the caller's connection
+            connection.close()
+    stats.seconds = time.monotonic() - start
+    stats.throughput = stats.payments / stats.seconds if stats.seconds else 0
+    return stats
+
+
+def _process_concurrently(
+    chunks, *, processors, cancel_on_failure, instrument, workers
+):
+    queue = Queue()
+    stop = threading.Event()
+    kwargs = {
+        "stop": stop,
+        "processors": processors,
+        "cancel_on_failure": cancel_on_failure,
+        "instrument": instrument,
+    }
+
+    with _count_queries() as counter:
+        if workers == 1:
+            for pks in chunks:
+                for pk in pks:
+                    queue.put(pk)
+            queue.put(_DONE)
+            results = [_worker(queue, **kwargs)]
+
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [
+                    executor.submit(_worker, queue, close_connection=True, **kwargs)
+                    for _ in range(workers)
+                ]
+                try:
+                    for pks in chunks:
+                        if stop.is_set():
+                            break
+                        for pk in pks:
+                            queue.put(pk)
+                except Exception:
+                    stop.set()
+                    raise
+                finally:
+                    for _ in range(workers):
+                        queue.put(_DONE)
+                results = [future.result() for future in futures]
+
+    return SimpleNamespace(
+        payments=sum(result.payments for result in results),
+        succeeded=sum(result.succeeded for result in results),
+        queries=counter.queries
+        + sum(result.queries for result in results if workers > 1),
+        workers=results,
+    )
+
+
+def _run(name, chunks, *, processors, cancel_on_failure, workers, instrument):
+    summary = Summary()
+    instrument = Instruments(summary, instrument)
+    start = time.perf_counter()
+    if workers is None:
+        stats = _process(
+            chunks,
+            processors=processors,
+            cancel_on_failure=cancel_on_failure,
+            instrument=instrument,
+        )
+    else:
+        stats = _process_concurrently(
+            chunks,
+            processors=processors,
+            cancel_on_failure=cancel_on_failure,
+            instrument=instrument,
+            workers=workers,
+        )
+    instrument.batch_processed(
+        name=name, stats=stats, seconds=time.perf_counter() - start
+    )
+    stats.summary = summary
+    return stats
+
+
+def _create_pending(*, bulk, chunk_size, prefetch=True):
+    users = get_user_model().objects.all()
+    if _has_stripe_customers():
+        users = users.select_related("stripe_customer").defer(
+            "stripe_customer__customer_data"
+        )
+    if bulk:
+        chunks = Payment.objects.create_pending_bulk(users=users, chunk_size=chunk_size)
+    else:
+        chunks = _create_pending_serially(users, chunk_size=chunk_size)
+    for payments in chunks:
+        if prefetch:
+            # Processors use payment.description
+            prefetch_related_objects(payments, "lineitems")
+        yield payments
+
+
+def _pks(chunks):
+    for payments in chunks:
+        yield [payment.pk for payment in payments]
+
+
+def _processing_queryset():
+    """
+    Pending payments with the data processors need
+    """
+    payments = Payment.objects.pending().with_description().defer("transaction")
+    if _has_stripe_customers():
+        return payments.select_related("user__stripe_customer").defer(
+            "user__stripe_customer__customer_data"
+        )
+    return payments.select_related("user")
+
+
+def _pending_payments(*, chunk_size, after, pks=False):
+    """
+    Yield lists of at most ``chunk_size`` pending payments (or only their
+    primary keys if ``pks`` is ``True``) ordered by their primary key,
+    starting after ``after``. Each chunk is fetched only when the previous
+    chunk has been processed.
+    """
+    if pks:
+        payments = Payment.objects.pending().values_list("pk", flat=True)
+    else:
+        payments = _processing_queryset()
+    payments = payments.order_by("pk")
+    while True:
+        chunk = payments if after is None else payments.filter(pk__gt=after)
+        chunk = list(chunk[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        after = chunk[-1] if pks else chunk[-1].pk
+
+
+def process_unbound_items(
+    *, processors, bulk=False, chunk_size=500, workers=None, instrument=None
+):
+    chunks = _create_pending(bulk=bulk, chunk_size=chunk_size, prefetch=workers is None)
+    return _run(
+        "process_unbound_items",
+        _pks(chunks) if workers is not None else chunks,
+        processors=processors,
+        cancel_on_failure=True,
+        workers=workers,
+        instrument=instrument,
+    )
+
+
+def process_pending_payments(
+    *, processors, workers=None, instrument=None, chunk_size=500, after=None
+):
+    return _run(
+        "process_pending_payments",
+        _pending_payments(chunk_size=chunk_size, after=after, pks=workers is not None),
+        processors=processors,
+        cancel_on_failure=False,
+        workers=workers,
+        instrument=instrument,
+    )
+
+
+async def _aprocess(
+    name, chunks, *, processors, cancel_on_failure, concurrency, instrument
+):
+    stats = SimpleNamespace(payments=0, succeeded=0)
+    semaphore = asyncio.Semaphore(concurrency)
+    summary = Summary()
+    instrument = Instruments(summary, instrument)
+    start = time.perf_counter()
+    # Synchronous processors share a bounded pool of threads which keep
+    # their database connection until the end of the run.
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    async def process(payment):
+        async with semaphore:
+            success = await aprocess_payment(
+                payment,
+                processors=processors,
+                cancel_on_failure=cancel_on_failure,
+                instrument=instrument,
+                executor=executor,
+            )
+        stats.payments += 1
+        if success:
+            stats.succeeded += 1
+
+    # Fetch chunks lazily, but always in the same thread.
+    next_chunk = sync_to_async(next)
+    try:
+        while True:
+            payments = await next_chunk(chunks, None)
+            if payments is None:
+                break
+            tasks = [asyncio.ensure_future(process(payment)) for payment in payments]
+            try:
+                await asyncio.gather(*tasks)
+            except Exception:
+                for task in tasks:
+                    task.cancel()
+                raise
+    finally:
+        await asyncio.get_running_loop().run_in_executor(
+            None, _shutdown_executor, executor, concurrency
+        )
+    instrument.batch_processed(
+        name=name, stats=stats, seconds=time.perf_counter() - start
+    )
+    stats.summary = summary
+    return stats
+
+
+async def aprocess_unbound_items(
+    *, processors, bulk=False, chunk_size=500, concurrency=10, instrument=None
+):
+    """
+    Asynchronous variant of ``process_unbound_items`` processing up to
+    ``concurrency`` payments at the same time
+    """
+    return await _aprocess(
+        "aprocess_unbound_items",
+        _create_pending(bulk=bulk, chunk_size=chunk_size),
+        processors=processors,
+        cancel_on_failure=True,
+        concurrency=concurrency,
+        instrument=instrument,
+    )
+
+
+async def aprocess_pending_payments(
+    *, processors, concurrency=10, instrument=None, chunk_size=500, after=None
+):
+    """
+    Asynchronous variant of ``process_pending_payments`` processing up to
+    ``concurrency`` payments at the same time
+    """
+    return await _aprocess(
+        "aprocess_pending_payments",
+        _pending_payments(chunk_size=chunk_size, after=after),
+        processors=processors,
+        cancel_on_failure=False,
+        concurrency=concurrency,
+        instrument=instrument,
+    )
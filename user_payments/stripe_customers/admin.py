@@ -28,10 +28,29 @@ def sanitize(data, *, key=None):
 
 @admin.register(models.Customer)
 class CustomerAdmin(admin.ModelAdmin):
-    list_display = ("user", "customer_id_admin", "created_at", "updated_at")
+    list_display = (
+        "user",
+        "customer_id_admin",
+        "card_brand",
+        "card_exp_admin",
+        "created_at",
+        "updated_at",
+    )
+    list_filter = ("card_brand",)
     raw_id_fields = ("user",)
     search_fields = ("user__email",)
 
+    def get_queryset(self, request):
+        # The customer blob is only loaded when it is actually needed
+        return super().get_queryset(request).defer("customer_data")
+
+    def card_exp_admin(self, instance):
+        if instance.card_exp_year:
+            return f"{instance.card_exp_month}/{instance.card_exp_year}"
+        return ""
+
+    card_exp_admin.short_description = _("card expiry")
+
     def customer_id_admin(self, instance):
         return str(instance)
 
@@ -1,3 +1,4 @@
+from datetime import timedelta
 from types import SimpleNamespace
 
 import stripe
@@ -9,6 +10,18 @@ from django.utils.translation import gettext_lazy as _
 class StripeCustomersConfig(AppConfig):
     name = "user_payments.stripe_customers"
     verbose_name = capfirst(_("stripe customers"))
+    default_settings = {
+        # Customer data older than this is refreshed before charging
+        "refresh_after": timedelta(days=30),
+        # Set to False if you refresh customers separately, e.g. using the
+        # refresh_stripe_customers management command
+        "refresh_on_charge": True,
+        # Size of the keep-alive connection pool used for all Stripe API
+        # calls unless stripe.default_http_client has been set already, set
+        # to None to keep the Stripe library's default client
+        "http_pool_size": 10,
+        "http_timeout": 30,
+    }
 
     def ready(self):
         from django.conf import settings
@@ -17,4 +30,14 @@ class StripeCustomersConfig(AppConfig):
         self.settings = SimpleNamespace(
             publishable_key=settings.STRIPE_PUBLISHABLE_KEY,
             secret_key=settings.STRIPE_SECRET_KEY,
+            **{**self.default_settings, **getattr(settings, "STRIPE_CUSTOMERS", {})},
         )
+
+        # Keep clients configured by the project, e.g. using a proxy
+        if self.settings.http_pool_size and stripe.default_http_client is None:
+            from .http import pooled_http_client
+
+            stripe.default_http_client = pooled_http_client(
+                pool_size=self.settings.http_pool_size,
+                timeout=self.settings.http_timeout,
+            )
@@ -0,0 +1,43 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import stripe
+from django.apps import apps
+
+
+def pooled_http_client(*, pool_size, timeout):
+    """
+    Return a Stripe HTTP client sharing one ``requests`` session between
+    all threads. Connections are kept alive and reused; at most
+    ``pool_size`` connections are opened, additional requests wait for a
+    free connection.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1, pool_maxsize=pool_size, pool_block=True
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return stripe.http_client.RequestsClient(timeout=timeout, session=session)
+
+
+def _create_charge(kwargs):
+    try:
+        return stripe.Charge.create(**kwargs)
+    except stripe.error.StripeError as exc:
+        return exc
+
+
+def create_charges(charges, *, workers=None):
+    """
+    Create many charges concurrently over the pooled HTTP client. ``charges``
+    is an iterable of keyword argument dictionaries for
+    ``stripe.Charge.create``; ``workers`` defaults to the ``http_pool_size``
+    setting.
+
+    Returns a list containing either the charge or the ``StripeError``
+    raised for each entry, in the order of ``charges``.
+    """
+    s = apps.get_app_config("stripe_customers").settings
+    with ThreadPoolExecutor(max_workers=workers or s.http_pool_size) as executor:
+        return list(executor.map(_create_charge, charges))
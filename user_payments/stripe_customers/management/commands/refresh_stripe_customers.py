@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from user_payments.stripe_customers.models import Customer
+
+
+class Command(BaseCommand):
+    help = "Refresh the data of Stripe customers which have become stale"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=100,
+            help="Number of customers loaded from the database at once",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="Number of concurrent requests to Stripe",
+        )
+
+    def handle(self, **options):
+        count = Customer.objects.refresh_stale(
+            chunk_size=options["chunk_size"], workers=options["workers"]
+        )
+        self.stdout.write(f"Refreshed {count} customers.")
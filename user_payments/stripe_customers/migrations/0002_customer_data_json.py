@@ -0,0 +1,102 @@
+import json
+
+from django.db import migrations, models
+
+
+def forwards(apps, schema_editor):
+    Customer = apps.get_model("stripe_customers", "Customer")
+    customers = []
+    for customer in Customer.objects.iterator():
+        data = (
+            json.loads(customer.customer_data_text)
+            if customer.customer_data_text
+            else None
+        )
+        source = (data or {}).get("default_source")
+        if not isinstance(source, dict):
+            source = {}
+        customer.customer_data = data
+        customer.card_brand = source.get("brand") or ""
+        customer.card_last4 = source.get("last4") or ""
+        customer.card_exp_month = source.get("exp_month")
+        customer.card_exp_year = source.get("exp_year")
+        customers.append(customer)
+        if len(customers) >= 500:
+            Customer.objects.bulk_update(customers, FIELDS)
+            customers = []
+    Customer.objects.bulk_update(customers, FIELDS)
+
+
+def backwards(apps, schema_editor):
+    Customer = apps.get_model("stripe_customers", "Customer")
+    customers = []
+    for customer in Customer.objects.iterator():
+        customer.customer_data_text = (
+            "" if customer.customer_data is None else json.dumps(customer.customer_data)
+        )
+        customers.append(customer)
+        if len(customers) >= 500:
+            Customer.objects.bulk_update(customers, ["customer_data_text"])
+            customers = []
+    Customer.objects.bulk_update(customers, ["customer_data_text"])
+
+
+FIELDS = [
+    "customer_data",
+    "card_brand",
+    "card_last4",
+    "card_exp_month",
+    "card_exp_year",
+]
+
+
+class Migration(migrations.Migration):
+    dependencies = [("stripe_customers", "0001_initial")]
+
+    operations = [
+        migrations.RenameField(
+            model_name="customer",
+            old_name="customer_data",
+            new_name="customer_data_text",
+        ),
+        migrations.AddField(
+            model_name="customer",
+            name="customer_data",
+            field=models.JSONField(blank=True, null=True, verbose_name="customer data"),
+        ),
+        migrations.AddField(
+            model_name="customer",
+            name="card_brand",
+            field=models.CharField(
+                blank=True, db_index=True, max_length=50, verbose_name="card brand"
+            ),
+        ),
+        migrations.AddField(
+            model_name="customer",
+            name="card_last4",
+            field=models.CharField(blank=True, max_length=4, verbose_name="card last4"),
+        ),
+        migrations.AddField(
+            model_name="customer",
+            name="card_exp_month",
+            field=models.PositiveSmallIntegerField(
+                blank=True, null=True, verbose_name="card expiry month"
+            ),
+        ),
+        migrations.AddField(
+            model_name="customer",
+            name="card_exp_year",
+            field=models.PositiveSmallIntegerField(
+                blank=True, null=True, verbose_name="card expiry year"
+            ),
+        ),
+        migrations.RunPython(forwards, backwards),
+        migrations.RemoveField(model_name="customer", name="customer_data_text"),
+        migrations.AddIndex(
+            model_name="customer",
+            index=models.Index(
+                fields=["card_exp_year", "card_exp_month"],
+                name="stripe_cust_card_exp_idx",
+            ),
+        ),
+    ]
@@ -1,13 +1,36 @@
 import hashlib
-import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
 
 import stripe
+from django.apps import apps
 from django.conf import settings
 from django.db import models
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 
+logger = logging.getLogger(__name__)
+
+
+def _retrieve(customer):
+    try:
+        return stripe.Customer.retrieve(customer.customer_id, expand=["default_source"])
+    except stripe.error.StripeError:
+        logger.exception("Failure refreshing %(customer)s", {"customer": customer})
+        return None
+
+
+class CustomerQuerySet(models.QuerySet):
+    def stale(self):
+        """
+        Return customers whose data is older than the ``refresh_after``
+        setting.
+        """
+        s = apps.get_app_config("stripe_customers").settings
+        return self.filter(updated_at__lt=timezone.now() - s.refresh_after)
+
+
 class CustomerManager(models.Manager):
     def with_token(self, *, user, token):
         """
@@ -30,10 +53,8 @@ class CustomerManager(models.Manager):
             % (hashlib.sha1(token.encode("utf-8")).hexdigest(),),
         )
         customer, created = self.update_or_create(
-            user=user,
-            defaults={"customer_id": obj.id, "customer_data": json.dumps(obj)},
+            user=user, defaults={"customer_id": obj.id, "customer_data": obj}
         )
-        customer._customer_data_cache = obj
         return customer
 
     def _update_token(self, user, token):
@@ -43,6 +64,33 @@ class CustomerManager(models.Manager):
         user.stripe_customer.refresh()
         return user.stripe_customer
 
+    def refresh_stale(self, *, chunk_size=100, workers=4):
+        """
+        Refresh all stale customers, ``chunk_size`` customers at a time.
+        Requests to Stripe are sent using a pool of ``workers`` threads,
+        customers are saved in the calling thread.
+
+        Returns the number of customers refreshed. Customers which cannot be
+        retrieved are logged and skipped.
+        """
+        count = 0
+        last_pk = None
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                customers = self.stale().defer("customer_data")
+                if last_pk is not None:
+                    customers = customers.filter(pk__gt=last_pk)
+                customers = list(customers.order_by("pk")[:chunk_size])
+                if not customers:
+                    return count
+
+                for customer, obj in zip(customers, executor.map(_retrieve, customers)):
+                    if obj is not None:
+                        customer.customer = obj
+                        customer.save()
+                        count += 1
+                last_pk = customers[-1].pk
+
 
 class Customer(models.Model):
     user = models.OneToOneField(
@@ -54,11 +102,29 @@ class Customer(models.Model):
     created_at = models.DateTimeField(_("created at"), default=timezone.now)
     updated_at = models.DateTimeField(_("updated at"), auto_now=True)
     customer_id = models.CharField(_("customer ID"), max_length=50, unique=True)
-    customer_data = models.TextField(_("customer data"), blank=True)
+    customer_data = models.JSONField(_("customer data"), blank=True, null=True)
+
+    # Extracted from the default source of customer_data when saving
+    card_brand = models.CharField(
+        _("card brand"), max_length=50, blank=True, db_index=True
+    )
+    card_last4 = models.CharField(_("card last4"), max_length=4, blank=True)
+    card_exp_month = models.PositiveSmallIntegerField(
+        _("card expiry month"), blank=True, null=True
+    )
+    card_exp_year = models.PositiveSmallIntegerField(
+        _("card expiry year"), blank=True, null=True
+    )
 
-    objects = CustomerManager()
+    objects = CustomerManager.from_queryset(CustomerQuerySet)()
 
     class Meta:
+        indexes = [
+            models.Index(
+                fields=["card_exp_year", "card_exp_month"],
+                name="stripe_cust_card_exp_idx",
+            )
+        ]
         verbose_name = _("customer")
         verbose_name_plural = _("customers")
 
@@ -66,34 +132,43 @@ class Customer(models.Model):
         return "{}{}".format(self.customer_id[:10], "*" * (len(self.customer_id) - 10))
 
     def save(self, *args, **kwargs):
-        if hasattr(self, "_customer_data_cache"):
-            self.customer_data = json.dumps(self._customer_data_cache)
-        if not self.customer_data:
+        if self.customer_data is None:
             self.refresh(save=False)
+        if "customer_data" not in self.get_deferred_fields():
+            self._extract_card()
         super().save(*args, **kwargs)
 
     save.alters_data = True
 
+    def _extract_card(self):
+        source = self.customer.get("default_source")
+        if not isinstance(source, dict):
+            # Not expanded
+            source = {}
+        self.card_brand = source.get("brand") or ""
+        self.card_last4 = source.get("last4") or ""
+        self.card_exp_month = source.get("exp_month")
+        self.card_exp_year = source.get("exp_year")
+
     @property
     def customer(self):
         """
-        Return the parsed version of the JSON blob or ``None`` if there is no
-        data around to be parsed.
+        Return the customer data or an empty dictionary if there is no data
+        around.
 
         After calling ``Customer.refresh()`` this property even returns the
         objects returned by the Stripe library as they come.
-
-        Does NOT work with ``instance.refresh_from_db()`` -- you have to fetch
-        a completely new object from the database.
         """
-        if not hasattr(self, "_customer_data_cache"):
-            self._customer_data_cache = json.loads(self.customer_data or "{}")
-        return self._customer_data_cache
+        return self.customer_data or {}
 
     @customer.setter
     def customer(self, value):
-        self._customer_data_cache = value
-        self.customer_data = json.dumps(self._customer_data_cache)
+        self.customer_data = value
+
+    @property
+    def needs_refresh(self):
+        s = apps.get_app_config("stripe_customers").settings
+        return timezone.now() - self.updated_at > s.refresh_after
 
     def refresh(self, save=True):
         self.customer = stripe.Customer.retrieve(
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from user_payments.user_subscriptions.models import Subscription
+
+
+class Command(BaseCommand):
+    help = "Recompute the end of the grace period of all subscriptions"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=500,
+            help="Number of subscriptions loaded from the database at once",
+        )
+
+    def handle(self, **options):
+        count = Subscription.objects.update_grace_period_ends_at(
+            chunk_size=options["chunk_size"]
+        )
+        self.stdout.write(f"Updated {count} subscriptions.")
@@ -0,0 +1,44 @@
+from datetime import datetime, time
+
+from django.apps import apps as global_apps
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def forwards(apps, schema_editor):
+    s = global_apps.get_app_config("user_payments").settings
+    Subscription = apps.get_model("user_subscriptions", "Subscription")
+    subscriptions = []
+    for subscription in Subscription.objects.only("paid_until").iterator():
+        subscription.grace_period_ends_at = (
+            timezone.make_aware(
+                datetime.combine(subscription.paid_until, time.max),
+                timezone.get_default_timezone(),
+            )
+            + s.grace_period
+        )
+        subscriptions.append(subscription)
+        if len(subscriptions) >= 1000:
+            Subscription.objects.bulk_update(subscriptions, ["grace_period_ends_at"])
+            subscriptions = []
+    Subscription.objects.bulk_update(subscriptions, ["grace_period_ends_at"])
+
+
+class Migration(migrations.Migration):
+    dependencies = [("user_subscriptions", "0001_initial")]
+
+    operations = [
+        migrations.AddField(
+            model_name="subscription",
+            name="grace_period_ends_at",
+            field=models.DateTimeField(
+                blank=True,
+                db_index=True,
+                editable=False,
+                help_text="Automatically calculated from the paid until date.",
+                null=True,
+                verbose_name="grace period ends at",
+            ),
+        ),
+        migrations.RunPython(forwards, migrations.RunPython.noop),
+    ]
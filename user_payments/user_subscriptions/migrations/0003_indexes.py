@@ -0,0 +1,38 @@
+from django.db import migrations, models
+
+
+FALLBACK_INDEX = models.Index(
+    fields=["renew_automatically", "paid_until"], name="user_subscr_renewing_fb"
+)
+
+
+def add_fallback_index(apps, schema_editor):
+    # Databases without partial indexes (e.g. MySQL) silently skip the
+    # conditional index below, add a composite index instead.
+    if not schema_editor.connection.features.supports_partial_indexes:
+        schema_editor.add_index(
+            apps.get_model("user_subscriptions", "Subscription"), FALLBACK_INDEX
+        )
+
+
+def remove_fallback_index(apps, schema_editor):
+    if not schema_editor.connection.features.supports_partial_indexes:
+        schema_editor.remove_index(
+            apps.get_model("user_subscriptions", "Subscription"), FALLBACK_INDEX
+        )
+
+
+class Migration(migrations.Migration):
+    dependencies = [("user_subscriptions", "0002_grace_period_ends_at")]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="subscription",
+            index=models.Index(
+                condition=models.Q(renew_automatically=True),
+                fields=["paid_until"],
+                name="user_subscr_renewing_idx",
+            ),
+        ),
+        migrations.RunPython(add_fallback_index, remove_fallback_index),
+    ]
@@ -1,18 +1,126 @@
+from bisect import bisect_right
+from contextlib import contextmanager
 from datetime import date, datetime, time, timedelta
+from threading import local
+from types import SimpleNamespace
 
 from django.apps import apps
 from django.conf import settings
-from django.db import models, transaction
-from django.db.models import Max, Q, signals
+from django.db import connection, models, transaction
+from django.db.models import Exists, F, Max, Min, OuterRef, Q, signals
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
-from user_payments.models import LineItem, Payment
+from user_payments.models import LineItem, Payment, balances_changed
 
-from .utils import recurring
+from .utils import index_after, occurrence, schedule
 
 
 class SubscriptionQuerySet(models.QuerySet):
+    def update_paid_until(self):
+        """
+        Set-based variant of ``Subscription.update_paid_until()``: Determines
+        the latest paid period of all subscriptions using one grouped query
+        and writes changed ``paid_until`` values using one bulk update.
+
+        Returns the number of subscriptions changed.
+        """
+        paid_until = dict(
+            SubscriptionPeriod.objects.paid()
+            .filter(subscription__in=self.values("pk"))
+            .values("subscription")
+            .annotate(m=Max("ends_on"))
+            .values_list("subscription", "m")
+        )
+        changed = []
+        for subscription in self.only(
+            "pk", "starts_on", "paid_until", "grace_period_ends_at"
+        ):
+            old = (subscription.paid_until, subscription.grace_period_ends_at)
+            subscription.paid_until = paid_until.get(subscription.pk)
+            subscription._clean_paid_until()
+            if (subscription.paid_until, subscription.grace_period_ends_at) != old:
+                changed.append(subscription)
+
+        self.model._default_manager.bulk_update(
+            changed, ["paid_until", "grace_period_ends_at"]
+        )
+        return len(changed)
+
+    def update_grace_period_ends_at(self, *, chunk_size=500):
+        """
+        Recompute the denormalized ``grace_period_ends_at`` using the current
+        ``grace_period`` setting, e.g. after changing the setting. Loads
+        ``chunk_size`` subscriptions at a time and writes changed values
+        using one bulk update per chunk.
+
+        Returns the number of subscriptions changed.
+        """
+        count = 0
+        changed = []
+        for subscription in self.only(
+            "pk", "paid_until", "grace_period_ends_at"
+        ).iterator(chunk_size=chunk_size):
+            old = subscription.grace_period_ends_at
+            subscription._update_grace_period_ends_at()
+            if subscription.grace_period_ends_at != old:
+                changed.append(subscription)
+            if len(changed) >= chunk_size:
+                self.model._default_manager.bulk_update(
+                    changed, ["grace_period_ends_at"]
+                )
+                count += len(changed)
+                changed = []
+
+        self.model._default_manager.bulk_update(changed, ["grace_period_ends_at"])
+        return count + len(changed)
+
+    update_grace_period_ends_at.alters_data = True
+
+    def delete_pending_periods(self):
+        """
+        Deletes all periods of the subscriptions which have not been paid for
+        yet together with their line items. Pending payments containing
+        those line items are canceled. Runs a fixed number of statements per
+        500 rows and updates ``paid_until`` once at the end instead of once
+        per deleted payment.
+
+        Returns the number of periods deleted.
+        """
+        periods = list(
+            SubscriptionPeriod.objects.filter(
+                subscription__in=self.values("pk"),
+                line_item__payment__charged_at__isnull=True,
+            ).values_list("pk", "line_item", "line_item__payment")
+        )
+        payments = sorted({payment for _, _, payment in periods if payment})
+        line_items = [line_item for _, line_item, _ in periods if line_item]
+
+        with transaction.atomic():
+            with _suppress_payment_changed():
+                for chunk in _chunks(payments):
+                    LineItem.objects.filter(payment__in=chunk).update(payment=None)
+                    Payment.objects.filter(pk__in=chunk).delete()
+            for chunk in _chunks([pk for pk, _, _ in periods]):
+                SubscriptionPeriod.objects.filter(pk__in=chunk).delete()
+            for chunk in _chunks(line_items):
+                LineItem.objects.filter(pk__in=chunk).delete()
+            if payments:
+                self.update_paid_until()
+        return len(periods)
+
+    delete_pending_periods.alters_data = True
+    # Like QuerySet.delete(), do not offer this on the manager where it
+    # would affect all subscriptions.
+    delete_pending_periods.queryset_only = True
+
+    def active(self):
+        """
+        Return subscriptions which are paid for or still in their grace
+        period. Uses the denormalized ``grace_period_ends_at`` field.
+        """
+        return self.filter(grace_period_ends_at__gte=timezone.now())
+
     def for_code(self, code):
         try:
             return self.get(code=code)
@@ -65,24 +173,181 @@ class SubscriptionManager(models.Manager):
             subscription.save()
         return subscription
 
-    def create_periods(self):
-        for subscription in self.filter(renew_automatically=True):
-            subscription.create_periods()
+    def ensure_many(self, rows, *, chunk_size=500):
+        """
+        Bulk variant of ``ensure()``: ``rows`` is an iterable of dictionaries
+        containing ``user``, ``code`` and additional fields for the
+        subscription.
+
+        Existing subscriptions are loaded using one query per chunk of
+        ``chunk_size`` rows and compared in memory. New subscriptions are
+        inserted using ``bulk_create``, changed subscriptions are updated
+        using ``bulk_update`` and their pending periods are removed set-wise.
+
+        Returns a list of ``(subscription, outcome)`` tuples in the order of
+        ``rows`` where outcome is one of ``"created"``, ``"changed"`` or
+        ``"unchanged"``.
+        """
+        rows = list(rows)
+        keys = [(row["user"].pk, row["code"]) for row in rows]
+        if len(set(keys)) != len(keys):
+            raise ValueError("ensure_many() received duplicate (user, code) rows")
+
+        results = []
+        for offset in range(0, len(rows), chunk_size):
+            with transaction.atomic():
+                results.extend(
+                    self._ensure_chunk(
+                        rows[offset : offset + chunk_size],
+                        keys[offset : offset + chunk_size],
+                    )
+                )
+        return results
+
+    def _ensure_chunk(self, rows, keys):
+        existing = {
+            (subscription.user_id, subscription.code): subscription
+            for subscription in self.filter(
+                user__in={user for user, _ in keys},
+                code__in={code for _, code in keys},
+            )
+        }
+
+        results = []
+        created, changed, fields = [], [], set()
+        for row, key in zip(rows, keys):
+            kwargs = {k: v for k, v in row.items() if k not in {"user", "code"}}
+            subscription = existing.get(key)
+            if subscription is None:
+                subscription = self.model(user=row["user"], code=row["code"], **kwargs)
+                if not subscription.starts_on:
+                    subscription.starts_on = date.today()
+                subscription._clean_paid_until()
+                created.append(subscription)
+                results.append((subscription, "created"))
+                continue
+
+            if all(getattr(subscription, k) == v for k, v in kwargs.items()):
+                results.append((subscription, "unchanged"))
+                continue
+
+            for k, v in kwargs.items():
+                setattr(subscription, k, v)
+            subscription._clean_paid_until()
+            if subscription.paid_until > date.today():
+                subscription.starts_on = subscription.paid_until + timedelta(days=1)
+                subscription._clean_paid_until()
+            fields.update(kwargs)
+            changed.append(subscription)
+            results.append((subscription, "changed"))
+
+        if changed:
+            self.filter(
+                pk__in=[subscription.pk for subscription in changed]
+            ).delete_pending_periods()
+            self.bulk_update(
+                changed,
+                sorted(fields | {"starts_on", "paid_until", "grace_period_ends_at"}),
+            )
+        self.bulk_create(created)
+        return results
+
+    def create_periods(self, *, until=None, chunk_size=500):
+        """
+        Create missing periods for all subscriptions which renew
+        automatically. The latest period of each subscription is determined
+        using one grouped query per chunk of subscriptions and the missing
+        periods are inserted using ``bulk_create``.
+
+        Returns a namespace containing the number of ``subscriptions``
+        processed and the number of ``periods`` sent to the database.
+        Periods which a concurrent run has inserted already are skipped by
+        the database but still counted, so the number is an upper bound
+        when runs overlap.
+        """
+        stats = SimpleNamespace(subscriptions=0, periods=0)
+        last_pk = None
+        while True:
+            subscriptions = self.filter(renew_automatically=True)
+            if last_pk is not None:
+                subscriptions = subscriptions.filter(pk__gt=last_pk)
+            subscriptions = list(
+                subscriptions.annotate(latest_ends_on=Max("periods__ends_on")).order_by(
+                    "pk"
+                )[:chunk_size]
+            )
+            if not subscriptions:
+                return stats
+
+            periods = [
+                period
+                for subscription in subscriptions
+                for period in subscription._missing_periods(
+                    latest_ends_on=subscription.latest_ends_on, until=until
+                )
+            ]
+            # The unique constraint on (subscription, starts_on) protects
+            # against creating periods twice when running concurrently.
+            SubscriptionPeriod.objects.bulk_create(
+                periods, batch_size=chunk_size, ignore_conflicts=True
+            )
 
-    def disable_autorenewal(self):
+            stats.subscriptions += len(subscriptions)
+            stats.periods += len(periods)
+            last_pk = subscriptions[-1].pk
+
+    def disable_autorenewal(
+        self, *, bulk=False, batch_size=500, max_batches=None, progress=None
+    ):
         """
         Disable autorenewal for subscriptions that are past due
 
         Uses the ``USER_PAYMENTS['disable_autorenewal_after']`` timedelta to
         determine the timespan after which autorenewal is disabled for unpaid
         subscriptions. Defaults to 15 days.
+
+        With ``bulk=True`` subscriptions are canceled ``batch_size`` at a time
+        using one ``UPDATE`` and a set-based removal of pending periods per
+        batch, each batch in its own transaction. ``max_batches`` bounds the
+        work done per call; canceled subscriptions do not match anymore, so
+        the next call continues where the previous one stopped. ``progress``
+        is called with a namespace containing the number of ``batches`` and
+        ``subscriptions`` processed so far after each batch.
+
+        Returns the number of subscriptions canceled.
         """
         s = apps.get_app_config("user_payments").settings
-        for subscription in self.filter(
+        past_due = self.filter(
             renew_automatically=True,
             paid_until__lt=timezone.now() - s.disable_autorenewal_after,
-        ):
-            subscription.cancel()
+        )
+        if not bulk:
+            count = 0
+            for subscription in past_due:
+                subscription.cancel()
+                count += 1
+            return count
+
+        stats = SimpleNamespace(batches=0, subscriptions=0)
+        while max_batches is None or stats.batches < max_batches:
+            with transaction.atomic():
+                pks = list(
+                    past_due.select_for_update(skip_locked=True)
+                    .order_by("pk")
+                    .values_list("pk", flat=True)[:batch_size]
+                )
+                if not pks:
+                    break
+                self.filter(pk__in=pks).update(
+                    renew_automatically=False, ends_on=F("paid_until")
+                )
+                self.filter(pk__in=pks).delete_pending_periods()
+
+            stats.batches += 1
+            stats.subscriptions += len(pks)
+            if progress:
+                progress(stats)
+        return stats.subscriptions
 
 
 class Subscription(models.Model):
@@ -137,10 +402,26 @@ class Subscription(models.Model):
 
     renew_automatically = models.BooleanField(_("renew automatically"), default=True)
     paid_until = models.DateField(_("paid until"), blank=True)
+    grace_period_ends_at = models.DateTimeField(
+        _("grace period ends at"),
+        blank=True,
+        null=True,
+        editable=False,
+        db_index=True,
+        help_text=_("Automatically calculated from the paid until date."),
+    )
 
     objects = SubscriptionManager.from_queryset(SubscriptionQuerySet)()
 
     class Meta:
+        indexes = [
+            # Subscription.objects.create_periods() and disable_autorenewal()
+            models.Index(
+                fields=["paid_until"],
+                condition=Q(renew_automatically=True),
+                name="user_subscr_renewing_idx",
+            )
+        ]
         unique_together = (("user", "code"),)
         verbose_name = _("subscription")
         verbose_name_plural = _("subscriptions")
@@ -148,19 +429,47 @@ class Subscription(models.Model):
     def __str__(self):
         return self.title
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_amount = instance.__dict__.get("amount")
+        return instance
+
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        self._loaded_amount = self.__dict__.get("amount")
+
+    def _amount_changed(self, update_fields):
+        if self._state.adding:
+            # Line items only exist for saved subscriptions.
+            return False
+        if update_fields is not None and "amount" not in update_fields:
+            return False
+        if "amount" not in self.__dict__:
+            # Deferred and never assigned.
+            return False
+        return getattr(self, "_loaded_amount", None) != self.amount
+
     def save(self, *args, **kwargs):
         if not self.starts_on:
             self.starts_on = date.today()
-        if not self.paid_until or self.paid_until < self.starts_on:
-            # New subscription instance or restarted subscription with
-            # inactivity period.
-            self.paid_until = self.starts_on - timedelta(days=1)
+        self._clean_paid_until()
+        amount_changed = self._amount_changed(kwargs.get("update_fields"))
         super().save(*args, **kwargs)
 
-        # Update unbound line items with new amount.
-        LineItem.objects.unbound().filter(subscriptionperiod__subscription=self).update(
-            amount=self.amount
-        )
+        #: Names of the propagation steps which ran during the last save,
+        #: useful for measuring the number of writes.
+        self.last_save_steps = []
+        if amount_changed:
+            # Update unbound line items with new amount.
+            if (
+                LineItem.objects.unbound()
+                .filter(subscriptionperiod__subscription=self)
+                .update(amount=self.amount, unit_amount=self.amount)
+            ):
+                balances_changed([self.user_id])
+            self.last_save_steps.append("line_item_amounts")
+        self._loaded_amount = self.__dict__.get("amount")
 
     save.alters_data = True
 
@@ -168,6 +477,8 @@ class Subscription(models.Model):
         self.paid_until = self.periods.paid().aggregate(m=Max("ends_on"))["m"]
         if save:
             self.save()
+        elif self.paid_until:
+            self._update_grace_period_ends_at()
 
     update_paid_until.alters_data = True
 
@@ -194,19 +505,32 @@ class Subscription(models.Model):
             datetime.combine(self.paid_until, time.max), timezone.get_default_timezone()
         )
 
-    @property
-    def grace_period_ends_at(self):
+    def _clean_paid_until(self):
+        if not self.paid_until or self.paid_until < self.starts_on:
+            # New subscription instance or restarted subscription with
+            # inactivity period.
+            self.paid_until = self.starts_on - timedelta(days=1)
+        self._update_grace_period_ends_at()
+
+    def _compute_grace_period_ends_at(self):
         s = apps.get_app_config("user_payments").settings
         return self.paid_until_at + s.grace_period
 
+    def _update_grace_period_ends_at(self):
+        self.grace_period_ends_at = self._compute_grace_period_ends_at()
+
+    # The properties below do not use the denormalized field, which is only
+    # up to date after saving.
+
     @property
     def is_active(self):
-        s = apps.get_app_config("user_payments").settings
-        return timezone.now() <= self.paid_until_at + s.grace_period
+        return timezone.now() <= self._compute_grace_period_ends_at()
 
     @property
     def in_grace_period(self):
-        return self.paid_until_at <= timezone.now() <= self.grace_period_ends_at
+        return (
+            self.paid_until_at <= timezone.now() <= self._compute_grace_period_ends_at()
+        )
 
     def create_periods(self, *, until=None):
         """
@@ -215,44 +539,61 @@ class Subscription(models.Model):
 
         ``until`` is interpreted as "up to and including".
         """
+        periods = self._missing_periods(
+            latest_ends_on=self.periods.aggregate(m=Max("ends_on"))["m"],
+            until=until,
+        )
+        for period in periods:
+            period.save(force_insert=True)
+        return periods
+
+    create_periods.alters_data = True
+
+    def _missing_periods(self, *, latest_ends_on, until=None):
+        """
+        Return unsaved period instances starting after ``latest_ends_on``
+        """
         end = until or date.today()
         if self.ends_on:
             end = min(self.ends_on, end)
-        days = recurring(self.starts_on, self.periodicity)
-        this_start = next(days)
 
-        latest_ends_on = self.periods.aggregate(m=Max("ends_on"))["m"]
+        if latest_ends_on is None:
+            # All periods are missing. The schedule is cached per
+            # (starts_on, periodicity, until) and shared between subscriptions.
+            days = schedule(self.starts_on, self.periodicity, until or date.today())
+            return [
+                SubscriptionPeriod(
+                    subscription=self,
+                    starts_on=date.fromordinal(days[i]),
+                    ends_on=date.fromordinal(days[i + 1] - 1),
+                )
+                for i in range(bisect_right(days, end.toordinal()))
+            ]
+
+        # Seek directly to the first missing period instead of walking the
+        # whole history.
         periods = []
-
-        if this_start <= end:
-            while True:
-                next_start = next(days)
-                if latest_ends_on is None or this_start > latest_ends_on:
-                    periods.append(
-                        self.periods.create(
-                            starts_on=this_start, ends_on=next_start - timedelta(days=1)
-                        )
-                    )
-                this_start = next_start
-
-                if this_start > end:
-                    break
-
+        i = index_after(self.starts_on, self.periodicity, latest_ends_on)
+        starts_on = occurrence(self.starts_on, self.periodicity, i)
+        while starts_on <= end:
+            next_starts_on = occurrence(self.starts_on, self.periodicity, i + 1)
+            periods.append(
+                SubscriptionPeriod(
+                    subscription=self,
+                    starts_on=starts_on,
+                    ends_on=next_starts_on - timedelta(days=1),
+                )
+            )
+            i, starts_on = i + 1, next_starts_on
         return periods
 
-    create_periods.alters_data = True
-
     def delete_pending_periods(self):
-        for period in self.periods.select_related("line_item__payment"):
-            line_item = period.line_item
-            if line_item:
-                if line_item.payment:
-                    if line_item.payment.charged_at:
-                        continue
-                    line_item.payment.cancel_pending()
-            period.delete()
-            if line_item:
-                line_item.delete()
+        """
+        Delete periods which have not been paid for yet and their line items
+        and cancel their pending payments. See
+        ``Subscription.objects.filter(...).delete_pending_periods()``.
+        """
+        return Subscription.objects.filter(pk=self.pk).delete_pending_periods()
 
     delete_pending_periods.alters_data = True
 
@@ -266,12 +607,61 @@ class Subscription(models.Model):
     cancel.alters_data = True
 
 
+def _chunks(seq, size=500):
+    for i in range(0, len(seq), size):
+        yield seq[i : i + size]
+
+
+_deferred = local()
+
+
+@contextmanager
+def defer_paid_until_updates():
+    """
+    Collect the subscriptions affected by payment changes inside the block
+    and update their ``paid_until`` date once, after the current
+    transaction has been committed (or when leaving the block if no
+    transaction is active).
+    """
+    if getattr(_deferred, "subscriptions", None) is not None:
+        # Nested, the outermost block updates subscriptions.
+        yield
+        return
+
+    _deferred.subscriptions = set()
+    try:
+        yield
+    finally:
+        subscriptions = sorted(_deferred.subscriptions)
+        _deferred.subscriptions = None
+
+        def update():
+            for chunk in _chunks(subscriptions):
+                Subscription.objects.filter(pk__in=chunk).update_paid_until()
+
+        if subscriptions:
+            transaction.on_commit(update)
+
+
+@contextmanager
+def _suppress_payment_changed():
+    _deferred.suppressed = True
+    try:
+        yield
+    finally:
+        _deferred.suppressed = False
+
+
 def payment_changed(sender, instance, **kwargs):
+    if getattr(_deferred, "suppressed", False):
+        return
     affected = SubscriptionPeriod.objects.filter(line_item__payment=instance.pk).values(
         "subscription"
     )
-    for subscription in Subscription.objects.filter(pk__in=affected):
-        subscription.update_paid_until()
+    if getattr(_deferred, "subscriptions", None) is not None:
+        _deferred.subscriptions.update(affected.values_list("subscription", flat=True))
+    else:
+        Subscription.objects.filter(pk__in=affected).update_paid_until()
 
 
 signals.post_save.connect(payment_changed, sender=Payment)
@@ -285,18 +675,89 @@ class SubscriptionPeriodManager(models.Manager):
         """
         return self.filter(line_item__payment__charged_at__isnull=False)
 
-    def create_line_items(self, *, until=None):
-        for period in self.filter(
-            line_item__isnull=True, starts_on__lte=until or date.today()
-        ):
-            period.create_line_item()
+    def create_line_items(self, *, until=None, chunk_size=500):
+        """
+        Create line items for all periods starting no later than ``until``
+        (today by default) which do not have a line item yet. Line items are
+        inserted using ``bulk_create`` and bound to their periods using
+        ``bulk_update``, ``chunk_size`` periods at a time.
 
-    def zeroize_pending_periods(self, *, lasting_until=None):
-        LineItem.objects.filter(
-            id__in=self.filter(
-                ~Q(id__in=self.paid()), Q(ends_on__lt=lasting_until or date.today())
-            ).values("line_item")
-        ).update(amount=0)
+        Returns the number of line items created.
+        """
+        count = 0
+        last_pk = None
+        while True:
+            periods = self.filter(
+                line_item__isnull=True, starts_on__lte=until or date.today()
+            ).select_related("subscription")
+            if last_pk is not None:
+                periods = periods.filter(pk__gt=last_pk)
+            periods = list(periods.order_by("pk")[:chunk_size])
+            if not periods:
+                return count
+
+            with transaction.atomic():
+                line_items = [
+                    LineItem(
+                        user_id=period.subscription.user_id,
+                        title=str(period),
+                        amount=period.subscription.amount,
+                        unit_amount=period.subscription.amount,
+                    )
+                    for period in periods
+                ]
+                if connection.features.can_return_rows_from_bulk_insert:
+                    LineItem.objects.bulk_create(line_items)
+                    balances_changed({item.user_id for item in line_items})
+                else:
+                    # Primary keys are required for binding line items
+                    for line_item in line_items:
+                        line_item.save(force_insert=True)
+
+                for period, line_item in zip(periods, line_items):
+                    period.line_item = line_item
+                self.bulk_update(periods, ["line_item"])
+
+            count += len(periods)
+            last_pk = periods[-1].pk
+
+    def zeroize_pending_periods(self, *, lasting_until=None, chunk_size=None):
+        """
+        Set the amount of line items of periods which have not been paid for
+        and which ended before ``lasting_until`` (today by default) to zero.
+
+        Uses correlated ``EXISTS`` and ``NOT EXISTS`` subqueries instead of
+        ``NOT IN``. If ``chunk_size`` is given, line items are updated in
+        ranges of ``chunk_size`` primary keys, one short statement each.
+
+        Returns the number of line items zeroized.
+        """
+        items = LineItem.objects.filter(
+            Exists(
+                self.filter(
+                    line_item=OuterRef("pk"),
+                    ends_on__lt=lasting_until or date.today(),
+                )
+            ),
+            ~Exists(
+                Payment.objects.filter(pk=OuterRef("payment"), charged_at__isnull=False)
+            ),
+        ).exclude(amount=0)
+
+        if chunk_size is None:
+            # Evaluated before updating, and only if balances are maintained.
+            balances_changed(items.values_list("user", flat=True).distinct())
+            return items.update(amount=0, unit_amount=0)
+
+        bounds = LineItem.objects.aggregate(lower=Min("id"), upper=Max("id"))
+        if bounds["lower"] is None:
+            return 0
+        count = 0
+        for lower in range(bounds["lower"], bounds["upper"] + 1, chunk_size):
+            chunk = items.filter(id__gte=lower, id__lt=lower + chunk_size)
+            balances_changed(chunk.values_list("user", flat=True).distinct())
+            count += chunk.update(amount=0, unit_amount=0)
+        return count
 
 
 class SubscriptionPeriod(models.Model):
@@ -1,31 +1,79 @@
+import calendar
+import functools
 import itertools
+from array import array
 from datetime import date, timedelta
 
 from user_payments.exceptions import UnknownPeriodicity
 
 
+MONTHS = {"yearly": 12, "quarterly": 3, "monthly": 1}
+
+
 def next_valid_day(year, month, day):
     """
     Return the next valid date for the given year, month and day combination.
 
-    Used by ``recurring`` below.
+    Months>12 increment the year. Days which do not exist in the given month
+    return the first day of the following month. Used by ``recurring`` below.
+    """
+    year += (month - 1) // 12
+    month = (month - 1) % 12 + 1
+    if day > calendar.monthrange(year, month)[1]:
+        return date(year + 1, 1, 1) if month == 12 else date(year, month + 1, 1)
+    return date(year, month, day)
+
+
+def _check_periodicity(periodicity):
+    if periodicity != "weekly" and periodicity not in MONTHS:
+        raise UnknownPeriodicity("Unknown periodicity %r" % periodicity)
+
+
+def occurrence(start, periodicity, n):
+    """
+    Return the ``n``-th (zero-based) date of the recurrence with the given
+    start date and periodicity.
+    """
+    _check_periodicity(periodicity)
+    if periodicity == "weekly":
+        return start + timedelta(days=n * 7)
+    return next_valid_day(start.year, start.month + n * MONTHS[periodicity], start.day)
+
+
+def index_after(start, periodicity, day):
     """
-    while True:
-        try:
-            return date(year, month, day)
-        except ValueError:
-            if month > 12:
-                month -= 12
-                year += 1
-                continue
-
-            day += 1
-            if day > 31:
-                day = 1
-                month += 1
-
-
-def recurring(start, periodicity):
+    Return the index of the first occurrence strictly later than ``day``.
+    """
+    _check_periodicity(periodicity)
+    if day < start:
+        return 0
+    if periodicity == "weekly":
+        return (day - start).days // 7 + 1
+
+    # Estimate the index using the difference in months; the estimated
+    # occurrence may be off by at most one step in each direction because
+    # invalid days are moved to the following month.
+    n = ((day.year - start.year) * 12 + day.month - start.month) // MONTHS[periodicity]
+    while occurrence(start, periodicity, n) <= day:
+        n += 1
+    while n > 0 and occurrence(start, periodicity, n - 1) > day:
+        n -= 1
+    return n
+
+
+def count_occurrences(start, periodicity, first, last):
+    """
+    Return the number of occurrences between ``first`` and ``last``
+    (inclusive).
+    """
+    if last < first:
+        return 0
+    return index_after(start, periodicity, last) - index_after(
+        start, periodicity, first - timedelta(days=1)
+    )
+
+
+def recurring(start, periodicity, *, after=None):
     """
     This generator yields valid dates with the given start date and
     periodicity.
@@ -34,32 +82,35 @@ def recurring(start, periodicity):
     periodicity and a starting date of 2016-02-29 (a leap year), dates for
     years that aren't leap years will be 20xx-03-01, not 20xx-02-28. However,
     leap year dates will stay on 20xx-02-29 and not be delayed.
+
+    If ``after`` is given the generator directly starts with the first date
+    later than ``after`` instead of walking all dates before.
     """
-    if periodicity == "yearly":
-        return (  # pragma: no branch
-            next_valid_day(start.year + i, start.month, start.day)
-            for i in itertools.count()
-        )
-
-    elif periodicity == "quarterly":
-        return (  # pragma: no branch
-            next_valid_day(start.year, start.month + i * 3, start.day)
-            for i in itertools.count()
-        )
-
-    elif periodicity == "monthly":
-        return (  # pragma: no branch
-            next_valid_day(start.year, start.month + i, start.day)
-            for i in itertools.count()
-        )
-
-    elif periodicity == "weekly":
-        return (  # pragma: no branch
-            start + timedelta(days=i * 7) for i in itertools.count()
-        )
-
-    else:
-        raise UnknownPeriodicity("Unknown periodicity %r" % periodicity)
+    _check_periodicity(periodicity)
+    first = 0 if after is None else index_after(start, periodicity, after)
+    return (  # pragma: no branch
+        occurrence(start, periodicity, i) for i in itertools.count(first)
+    )
+
+
+@functools.lru_cache(maxsize=1024)
+def schedule(start, periodicity, until):
+    """
+    Return the occurrences up to and including ``until`` plus the first
+    occurrence after ``until`` as a compact array of ordinal day numbers.
+
+    Subscriptions often share start dates and periodicities, therefore
+    schedules are cached per process. ``schedule.cache_info()`` returns hit
+    and miss counters. The returned arrays are shared and must not be
+    modified.
+    """
+    return array(
+        "l",
+        (
+            occurrence(start, periodicity, i).toordinal()
+            for i in range(index_after(start, periodicity, until) + 1)
+        ),
+    )
 
 
 if __name__ == "__main__":  # pragma: no cover